@@ -1,11 +1,14 @@
-import csv
+import asyncio
+import json
+from functools import partial
 from threading import Thread
-from time import sleep
-from typing import List
+from time import sleep, time
+from typing import Dict, List, Optional, Tuple
 
 import uvicorn
-from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi import FastAPI, Query
+from pydantic import BaseModel, conint, conlist
+from sqlalchemy.exc import IntegrityError
 from starlette.authentication import (
     AuthCredentials,
     AuthenticationBackend,
@@ -19,32 +22,158 @@ from starlette.middleware import Middleware
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import HTTPConnection, Request
-from starlette.responses import JSONResponse, Response
+from starlette.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 
-from database import GameSession, _DBUser, Exercise
+import catalog
+import config
+from attacklog import attacks
+from cache import principals, profiles
+from channel import channel
+from database import (
+    DAY,
+    SINGLE_CONNECTION,
+    GameSession,
+    PartyError,
+    _DBUser,
+    after_commit,
+    commit_now,
+)
+from executor import run_db
 from friend import Friend
+from graph import graph
+from hashing import Saturated, hasher
+from hub import hub
+from leaderboard import leaderboard
+from middleware import (
+    FirstRequestMiddleware,
+    MetricsMiddleware,
+    RateLimitMiddleware,
+    UnitOfWorkMiddleware,
+    clock,
+    commit_stats,
+)
+from metrics import metrics
+from migrations import migrate
+from ratelimit import limits
+from reaper import reaper
 from session import SessionInfo
+from tokens import Claims, tokens
 from user import User, session_manager
+from versions import versions
 
 
 class SessionAuth(AuthenticationBackend):
+    def __init__(self):
+        # lookups in flight, so a burst of requests on a cold token (e.g. a
+        # party attacking right after a kill) only queries once
+        self._loading: Dict[str, asyncio.Future] = {}
+
     async def authenticate(self, request: HTTPConnection):
         token = request.cookies.get("session")
         if not token:
             return
-        user = SessionInfo.find(token)
+        claims = None
+        if config.TOKEN_MODE == "signed":
+            # checked on every request, so expiry and revocation apply to
+            # cached principals too
+            claims = tokens.verify(token)
+            if not claims:
+                return
+        user = principals.get(token) or await self._load(token, claims)
         if not user:
             return
-        user.set_authenticated(token=token)
         return AuthCredentials(["authenticated"]), user
 
+    async def _load(self, token: str, claims: Optional[Claims]) -> Optional[User]:
+        loading = self._loading.get(token)
+        if loading is None:
+            loading = asyncio.ensure_future(self._find(token, claims))
+            self._loading[token] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(token, None))
+        return await loading
+
+    async def _find(self, token: str, claims: Optional[Claims]) -> Optional[User]:
+        while True:
+            loaded = principals.generation
+            if claims:
+                # signed tokens name their user, no session lookup needed
+                user = await run_db(User.find, id=claims.user_id)
+            else:
+                user = await run_db(SessionInfo.find, token)
+            if not user:
+                return
+            user.set_authenticated(token=token)
+            # loaded before a write that invalidated the user, whose ETags
+            # may already have moved on: load it again
+            if principals.set(token, user, loaded):
+                return user
+
 
 middleware = [
+    Middleware(MetricsMiddleware),
+    Middleware(FirstRequestMiddleware),
     Middleware(CORSMiddleware, allow_origins=["*"]),
     Middleware(AuthenticationMiddleware, backend=SessionAuth()),
+    Middleware(RateLimitMiddleware),
+    # inside authentication, so cached principals never hold objects of a
+    # request's session
+    Middleware(UnitOfWorkMiddleware),
 ]
 
+
+def startup():
+    migrate()
+    channel.prepare()
+    catalog.store(catalog.load())
+    if config.SEED_DEMO:
+        seed_demo()
+    if attacks.enabled:
+        # may pay out kills, before the leaderboard is read
+        attacks.recover()
+    with session_manager() as session:
+        leaderboard.load(session.query(_DBUser.id, _DBUser.username, _DBUser.points))
+        if config.TOKEN_MODE == "signed":
+            tokens.load(session)
+        graph.load(session.query(Friend.user_id, Friend.friend_id, Friend.confirmed))
+
+
+async def lifespan(_: FastAPI):
+    """
+    Startup and shutdown, as the async generator starlette's router expects.
+    """
+    clock.begin()
+    hasher.start()
+    await run_db(startup)
+    reaper.start()
+    channel.start()
+    if attacks.enabled:
+        attacks.start()
+    clock.ready()
+    try:
+        yield
+    finally:
+        await attacks.stop()
+        await channel.stop()
+        await reaper.stop()
+        hasher.shutdown()
+
+
 app = FastAPI(middleware=middleware)
+app.router.lifespan_context = lifespan
+
+
+@app.exception_handler(Saturated)
+async def saturated(_: Request, __: Saturated) -> JSONResponse:
+    return JSONResponse(
+        {"success": False, "detail": "Server busy, try again shortly"},
+        status_code=503,
+        headers={"Retry-After": "1"},
+    )
 
 
 class Credentials(BaseModel):
@@ -66,9 +195,25 @@ class SessionCreateForm(BaseModel):
     tag: str
 
 
+class BulkSessionCreateForm(BaseModel):
+    sessions: conlist(SessionCreateForm, min_items=1, max_items=100)
+
+
 class AttackForm(BaseModel):
     id: int
-    damage: int
+    # what fits the attack log's signed 64-bit damage field
+    damage: conint(ge=1, le=2**63 - 1)
+
+
+class ProfilesForm(BaseModel):
+    ids: conlist(int, max_items=config.PROFILE_BATCH) = []
+    usernames: conlist(str, max_items=config.PROFILE_BATCH) = []
+
+
+class WorkoutForm(BaseModel):
+    tags: List[str] = []
+    difficulty: str = "beginner"
+    minutes: conint(ge=1, le=config.WORKOUT_MAX_MINUTES) = 20
 
 
 class BuyForm(BaseModel):
@@ -76,155 +221,360 @@ class BuyForm(BaseModel):
     price: int
 
 
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """
+    An empty 304 if the client's copy, named in If-None-Match, is current.
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return
+    tags = {tag.strip().replace("W/", "", 1) for tag in header.split(",")}
+    if "*" in tags or etag.replace("W/", "", 1) in tags:
+        return Response(status_code=304, headers={"ETag": etag})
+
+
 def renew(response: Response, token: str = None):
     if not token:
         return response
-    # two week expiry
     response.set_cookie(
-        "session", token, max_age=(3600 * 24 * 14), samesite="none", secure=True
+        "session",
+        token,
+        max_age=int(config.TOKEN_LIFETIME),
+        samesite="none",
+        secure=True,
     )
     return response
 
 
 @app.post("/login")
 async def login(_: Request, form: Credentials) -> JSONResponse:
-    tests()
-    user = User.find(username=form.username)
+    user = await run_db(User.find, username=form.username)
     if not user:
         raise HTTPException(403, "Invalid username or password")
-    user.authenticate(form.password)
-    if not user.is_authenticated:
+    valid, new_hash = await hasher.verify(form.password, user.hash)
+    if not valid:
         raise HTTPException(403, "Invalid username or password")
-    token = user.new_token()
+    user.set_authenticated()
+    if new_hash:
+        await run_db(user.rehash, new_hash)
+    token = await run_db(user.new_token)
     response = JSONResponse({"success": True})
     return renew(response, token)
 
 
 @app.post("/register")
 async def register(form: Credentials) -> JSONResponse:
-    if User.find(username=form.username):
+    if await run_db(User.find, username=form.username):
+        raise HTTPException(400, "User with this username already exists")
+    user = User.create(form.username, await hasher.hash(form.password))
+    try:
+        await run_db(user.write)
+    except IntegrityError:
+        # lost a race against another registration for the same name
         raise HTTPException(400, "User with this username already exists")
-    user = User.register(form.username, form.password)
-    user.write()
     return JSONResponse({"success": True})
 
 
 @app.post("/add_friend")
 @requires("authenticated")
 async def add_friend(request: Request, friend_form: FriendForm) -> JSONResponse:
-    id = User.find(username=friend_form.username).id
-    with session_manager() as session:
-        friend = Friend.query_both(
-            user_id=User.find(username=friend_form.username).id,
-            friend_id=request.user.id,
-            session=session,
-        )
-    if friend:
-        return renew(JSONResponse({"success": False}), request.user.token)
-    request.user.new_friend(id)
-    return renew(JSONResponse({"success": True}), request.user.token)
+    def add() -> bool:
+        id = User.find(username=friend_form.username).id
+        # a request either way, or a friendship, already links them
+        if id == request.user.id or graph.linked(id, request.user.id):
+            return False
+        try:
+            request.user.new_friend(id)
+        except IntegrityError:
+            # the graph hadn't seen a request either way committed meanwhile
+            return False
+        return True
+
+    success = await run_db(add)
+    return renew(JSONResponse({"success": success}), request.user.token)
+
+
+def befriended(*user_ids: int):
+    channel.broadcast("invalidate_user", *user_ids)
+    channel.broadcast("bump", user_ids, "friends")
 
 
 @app.post("/accept_friend")
 @requires("authenticated")
 async def accept_friend(request: Request, friend_form: FriendForm) -> JSONResponse:
-    with session_manager() as session:
-        friend = Friend.query_both(
-            user_id=User.find(username=friend_form.username).id,
-            friend_id=request.user.id,
-            session=session,
-        )
-        friend.confirmed = True
-        friend.write(session=session)
+    def accept():
+        with session_manager() as session:
+            friend = Friend.query_both(
+                user_id=User.find(username=friend_form.username).id,
+                friend_id=request.user.id,
+                session=session,
+            )
+            friend.confirmed = True
+            friend.write(session=session)
+            users = friend.user_id, friend.friend_id
+            after_commit(session, partial(channel.broadcast, "friend_confirm", *users))
+            after_commit(session, partial(befriended, *users))
+
+    await run_db(accept)
     return renew(JSONResponse({"success": True}))
 
 
 @app.post("/deny_friend")
 @requires("authenticated")
 async def deny_friend(request: Request, friend_form: FriendForm) -> JSONResponse:
-    with session_manager() as session:
-        friend = Friend.query_both(
-            user_id=User.find(username=friend_form.username).id,
-            friend_id=request.user.id,
-            session=session,
-        )
-        friend.delete(session=session)
+    def deny():
+        with session_manager() as session:
+            friend = Friend.query_both(
+                user_id=User.find(username=friend_form.username).id,
+                friend_id=request.user.id,
+                session=session,
+            )
+            users = friend.user_id, friend.friend_id
+            friend.delete(session=session)
+            after_commit(session, partial(channel.broadcast, "friend_remove", *users))
+            after_commit(session, partial(befriended, *users))
+
+    await run_db(deny)
     return renew(JSONResponse({"success": True}))
 
 
 @app.get("/friends_list")
 @requires("authenticated")
-async def friends_list(request: Request) -> JSONResponse:
-    friends = Friend.find(id=request.user.id) or []
-    friends_list = []
-    for friend in friends:
-        # if not accepted, don't show on requester's side
-        if friend.user_id == request.user.id and not friend.confirmed:
-            continue
-        if friend.user_id == request.user.id:
-            if not friend.confirmed:
-                continue
-            friend_id = friend.friend_id
-        else:
-            friend_id = friend.user_id
-        user = User.find(id=friend_id)
-        friends_list.append(
-            {
-                "id": friend_id,
-                "name": user.username,
-                "confirmed": friend.confirmed,
-                "avatar": user.avatar,
-            }
-        )
+async def friends_list(
+    request: Request,
+    limit: int = Query(100, ge=1, le=500),
+    after_id: Optional[int] = None,
+) -> Response:
+    etag = versions.etag(request.user.id, "friends")
+    cached = not_modified(request, etag)
+    if cached:
+        return renew(cached, request.user.token)
+
+    def collect() -> List[Dict]:
+        with session_manager() as session:
+            return Friend.page(request.user.id, session, limit, after_id)
+
+    friends_list = await run_db(collect)
+    # cursor for the next page, if this one was full
+    next_id = friends_list[-1]["id"] if len(friends_list) == limit else None
     return renew(
-        JSONResponse({"success": True, "friends": friends_list}), request.user.token
+        JSONResponse(
+            {"success": True, "friends": friends_list, "next": next_id},
+            headers={"ETag": etag},
+        ),
+        request.user.token,
     )
 
 
+@app.get("/friend_suggestions")
+@requires("authenticated")
+async def friend_suggestions(request: Request, limit: int = Query(10, ge=1, le=50)):
+    """
+    Friends of friends, ranked by how many friends they have in common.
+    """
+    suggested = dict(graph.suggest(request.user.id, limit))
+
+    def users() -> List[Tuple[int, str, str]]:
+        with session_manager() as session:
+            return (
+                session.query(_DBUser.id, _DBUser.username, _DBUser.avatar)
+                .filter(_DBUser.id.in_(suggested))
+                .all()
+            )
+
+    found = {id: (name, avatar) for id, name, avatar in await run_db(users)}
+    suggestions = [
+        {"id": id, "name": found[id][0], "avatar": found[id][1], "mutual": mutual}
+        for id, mutual in suggested.items()
+        if id in found
+    ]
+    return renew(
+        JSONResponse({"success": True, "suggestions": suggestions}),
+        request.user.token,
+    )
+
+
+async def create_parties(
+    request: Request, forms: List[SessionCreateForm]
+) -> List[Dict]:
+    def create() -> List[Tuple[Dict, List[int]]]:
+        with session_manager() as session:
+            created = GameSession.create_many(
+                session,
+                (request.user.id, request.user.username),
+                [(form.name, form.tag, form.users) for form in forms],
+            )
+            for game_session, user_ids in created:
+                after_commit(
+                    session, partial(channel.broadcast, "invalidate_user", *user_ids)
+                )
+                after_commit(
+                    session, partial(channel.broadcast, "bump", user_ids, "sessions")
+                )
+                after_commit(
+                    session,
+                    partial(channel.broadcast, "publish", user_ids, game_session),
+                )
+            return created
+
+    try:
+        created = await run_db(create)
+    except PartyError as e:
+        raise HTTPException(400, str(e))
+    return [game_session for game_session, _ in created]
+
+
 @app.post("/create_session")
 @requires("authenticated")
 async def create_session(request: Request, form: SessionCreateForm):
-    users = []
-    with session_manager() as session:
-        for user in form.users:
-            user = _DBUser.query_unique(session, {"username": user})
-            users.append(user)
-            user.write(session)
-        users.append(_DBUser.query_unique(session, {"username": request.user.username}))
-        game_session = GameSession(name=form.name, users=users, tag=form.tag)
-        game_session.write(session)
-        return renew(
-            JSONResponse({"success": True, **game_session.as_dict()}),
-            request.user.token,
-        )
+    (game_session,) = await create_parties(request, [form])
+    return renew(
+        JSONResponse({"success": True, **game_session}),
+        request.user.token,
+    )
+
+
+@app.post("/create_sessions")
+@requires("authenticated")
+async def create_sessions(request: Request, form: BulkSessionCreateForm):
+    """
+    Create many sessions at once, e.g. for scheduled group events.
+    """
+    game_sessions = await create_parties(request, form.sessions)
+    return renew(
+        JSONResponse({"success": True, "sessions": game_sessions}),
+        request.user.token,
+    )
+
+
+def attacked(id: int, game_session: Dict, user_ids: List[int]):
+    """
+    Push a session's new boss health to the party's live streams.
+    """
+    if game_session:
+        delta = {
+            "id": id,
+            "bossHealth": game_session["bossHealth"],
+            "partyHealth": game_session["partyHealth"],
+        }
+    else:
+        delta = {"id": id, "bossHealth": 0, "killed": True}
+    channel.broadcast("publish", user_ids, delta)
 
 
 @app.post("/attack")
 @requires("authenticated")
 async def attack(request: Request, form: AttackForm):
-    with session_manager() as session:
-        game_session = GameSession.find(session, id=form.id)
-        game_session.bossHealth -= form.damage
-        if game_session.bossHealth <= 0:
-            for user in game_session.users:
-                user.points += 100
-            game_session.delete(session)
-            return renew(
-                JSONResponse({"success": True}),
-                request.user.token,
-            )
-        game_session.write(session)
-        return renew(
-            JSONResponse({"success": True, **game_session.as_dict()}),
-            request.user.token,
-        )
+    def apply() -> Optional[Tuple[Dict, List[int]]]:
+        with session_manager() as session:
+            result = GameSession.attack(session, form.id, form.damage)
+            if result is not None:
+                after_commit(session, partial(attacked, form.id, *result))
+            commit_now(session)
+            return result
+
+    if attacks.enabled:
+        result = await attacks.attack(form.id, request.user.id, form.damage)
+        if result is not None:
+            # the attack is already written to the log
+            attacked(form.id, *result)
+    else:
+        result = await run_db(apply)
+    if result is None:
+        raise HTTPException(404, "Session not found")
+    game_session, _ = result
+    return renew(
+        JSONResponse({"success": True, **game_session}),
+        request.user.token,
+    )
+
+
+@app.get("/damage")
+@requires("authenticated")
+async def damage(request: Request):
+    """
+    Damage the user has dealt, attacks made and bosses killed, counted by
+    the attack log.
+    """
+    if not attacks.enabled:
+        raise HTTPException(404, "Damage stats need the attack log")
+    dealt, made, kills = attacks.totals.get(request.user.id, (0, 0, 0))
+    return renew(
+        JSONResponse(
+            {"success": True, "damage": dealt, "attacks": made, "kills": kills}
+        ),
+        request.user.token,
+    )
+
+
+@app.get("/sessions/{id}/damage")
+@requires("authenticated")
+async def session_damage(request: Request, id: int):
+    """
+    Damage each member of one of the user's live sessions has dealt, most
+    first.
+    """
+    if not attacks.enabled:
+        raise HTTPException(404, "Damage stats need the attack log")
+    party = await attacks.party(id)
+    if party is None or request.user.id not in party.user_ids:
+        raise HTTPException(404, "Session not found")
+    dealt = attacks.by_member.get(id, {})
+    members = sorted(
+        (
+            {"id": user_id, "username": username, "damage": dealt.get(user_id, 0)}
+            for user_id, username in zip(party.user_ids, party.usernames)
+        ),
+        key=lambda x: -x["damage"],
+    )
+    return renew(
+        JSONResponse({"success": True, "members": members}),
+        request.user.token,
+    )
 
 
 @app.get("/points")
 @requires("authenticated")
 async def points(request: Request):
+    etag = versions.etag(request.user.id, "points")
+    response = not_modified(request, etag) or JSONResponse(
+        {"success": True, "points": request.user.points}, headers={"ETag": etag}
+    )
+    return renew(response, request.user.token)
+
+
+@app.get("/leaderboard")
+@requires("authenticated")
+async def leaderboard_top(
+    request: Request, limit: int = Query(10, ge=1, le=100), friends: bool = False
+):
+    if friends:
+
+        def friend_ids() -> List[int]:
+            with session_manager() as session:
+                return Friend.confirmed_ids(request.user.id, session)
+
+        ids = await run_db(friend_ids)
+        entries = leaderboard.among([request.user.id, *ids], limit)
+    else:
+        entries = leaderboard.top(limit)
     return renew(
-        JSONResponse({"success": True, "points": request.user.points}),
+        JSONResponse({"success": True, "leaderboard": entries}),
+        request.user.token,
+    )
+
+
+@app.get("/rank")
+@requires("authenticated")
+async def rank(request: Request):
+    return renew(
+        JSONResponse(
+            {
+                "success": True,
+                "rank": leaderboard.rank(request.user.id),
+                "players": len(leaderboard),
+            }
+        ),
         request.user.token,
     )
 
@@ -237,80 +587,277 @@ async def buy(request: Request, form: BuyForm):
             JSONResponse({"success": False}),
             request.user.token,
         )
-    with session_manager() as session:
-        user = _DBUser.query_unique(session, {"id": request.user.id})
-        user.points -= form.price
-        user.avatar = form.avatar
-        user.write(session)
+
+    def spend() -> bool:
+        with session_manager() as session:
+            if not _DBUser.spend(session, request.user.id, form.price, form.avatar):
+                commit_now(session)
+                return False
+            # friends lists show the avatar
+            linked = Friend.linked_ids(request.user.id, session)
+
+            def spent():
+                leaderboard.add([request.user.id], -form.price)
+                channel.send("points", [request.user.id])
+                channel.broadcast("invalidate_user", request.user.id)
+                channel.broadcast("invalidate_profile", request.user.id)
+                channel.broadcast("bump", [request.user.id], "points")
+                channel.broadcast("bump", [request.user.username], "avatar")
+                channel.broadcast("bump", linked, "friends")
+
+            after_commit(session, spent)
+            commit_now(session)
+            return True
+
+    if not await run_db(spend):
+        # the cached principal's points were out of date
+        return renew(
+            JSONResponse({"success": False}),
+            request.user.token,
+        )
     return renew(
         JSONResponse({"success": True}),
         request.user.token,
     )
 
 
+async def find_profiles(ids: List[int], usernames: List[str]) -> List[Dict]:
+    """
+    Profiles from the cache, with one query for any that aren't in it.
+    """
+    found, ids, usernames = profiles.get_many(ids, usernames)
+    if ids or usernames:
+
+        def load() -> List[Dict]:
+            with session_manager() as session:
+                return _DBUser.profiles(session, ids, usernames)
+
+        loaded = profiles.generation
+        for profile in await run_db(load):
+            profiles.set(profile["id"], profile, loaded)
+            found.append(profile)
+    return found
+
+
 @app.post("/avatar")
 @requires("authenticated")
 async def avatar(request: Request, form: AvatarForm):
-    avatar = User.find(username=form.username).avatar
+    etag = versions.etag(form.username, "avatar")
+    cached = not_modified(request, etag)
+    if cached:
+        return renew(cached, request.user.token)
+    found = await find_profiles([], [form.username])
+    if not found:
+        raise HTTPException(404, "User not found")
+    profile = found[0]
+    return renew(
+        JSONResponse(
+            {"success": True, "avatar": profile["avatar"]}, headers={"ETag": etag}
+        ),
+        request.user.token,
+    )
+
+
+@app.post("/profiles")
+@requires("authenticated")
+async def profiles_batch(request: Request, form: ProfilesForm):
+    """
+    Username, avatar and points of up to PROFILE_BATCH users each by id and
+    by username, e.g. everyone on a party or friends screen at once.
+    Unknown users are left out.
+    """
+    found = await find_profiles(form.ids, form.usernames)
+    # each user once, even if asked for by both id and username
+    unique = list({profile["id"]: profile for profile in found}.values())
     return renew(
-        JSONResponse({"success": True, "avatar": avatar}),
+        JSONResponse({"success": True, "profiles": unique}),
         request.user.token,
     )
 
 
+def live_sessions(user_id: int) -> List[Dict]:
+    # read fresh, the principal's copy may predate other members' attacks
+    with session_manager() as db_session:
+        game_sessions = GameSession.for_user(db_session, user_id)
+        if game_sessions:
+            # party health drops every full day after a session's start
+            now = time()
+            versions.expire(
+                user_id,
+                "sessions",
+                min(now + DAY - (now - x.startTime) % DAY for x in game_sessions),
+            )
+        return [session.as_dict() for session in game_sessions]
+
+
 @app.get("/sessions")
 @requires("authenticated")
 async def sessions(request: Request):
-    sessions = []
-    for session in request.user.sessions:
-        if session.check_status():
-            sessions.append(session.as_dict())
+    # the catalog lists each session's exercises
+    etag = versions.etag(request.user.id, "sessions", int(catalog.catalog().mtime))
+    cached = not_modified(request, etag)
+    if cached:
+        return renew(cached, request.user.token)
+    sessions = await run_db(live_sessions, request.user.id)
     return renew(
-        JSONResponse({"success": True, "sessions": sessions}),
+        JSONResponse({"success": True, "sessions": sessions}, headers={"ETag": etag}),
         request.user.token,
     )
 
 
+@app.get("/exercises/search")
+@requires("authenticated")
+async def search_exercises(
+    request: Request,
+    prefix: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(10, ge=1, le=50),
+):
+    """
+    Exercises with a word in their name starting with `prefix`.
+    """
+    found = catalog.catalog().search(prefix, limit)
+    return renew(
+        JSONResponse({"success": True, "exercises": [x.as_dict() for x in found]}),
+        request.user.token,
+    )
+
+
+@app.post("/workout_plan")
+@requires("authenticated")
+async def workout_plan(request: Request, form: WorkoutForm):
+    """
+    A workout of `minutes` for the given tags (all of them if none) at the
+    given difficulty, one exercise every WORKOUT_EXERCISE_SECONDS.
+    """
+    if any(tag not in catalog.TAG_BITS for tag in form.tags):
+        raise HTTPException(400, "Unknown tag")
+    if form.difficulty not in catalog.LEVELS:
+        raise HTTPException(400, "Unknown difficulty")
+    slots = max(form.minutes * 60 // config.WORKOUT_EXERCISE_SECONDS, 1)
+    plan = catalog.catalog().plan(catalog.tag_mask(form.tags), form.difficulty, slots)
+    return renew(
+        JSONResponse(
+            {
+                "success": True,
+                "seconds": config.WORKOUT_EXERCISE_SECONDS,
+                "exercises": [x.as_dict() for x in plan],
+            }
+        ),
+        request.user.token,
+    )
+
+
+def event(name: str, data) -> str:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.get("/sessions/stream")
+@requires("authenticated")
+async def sessions_stream(request: Request):
+    """
+    Server-sent events: a `snapshot` of the user's sessions, then `boss`
+    events carrying the sessions that changed since the last one.
+    """
+    # subscribed first, so no update between the snapshot and the stream is
+    # missed
+    subscriber = hub.subscribe(request.user.id)
+    try:
+        snapshot = await run_db(live_sessions, request.user.id)
+    except BaseException:
+        # the stream below never starts, so it won't unsubscribe
+        hub.unsubscribe(subscriber)
+        raise
+
+    async def events():
+        try:
+            yield event("snapshot", snapshot)
+            while not await request.is_disconnected():
+                deltas = await subscriber.next(config.STREAM_HEARTBEAT)
+                yield event("boss", deltas) if deltas else ": keepalive\n\n"
+        finally:
+            hub.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/cache_stats")
+async def cache_stats() -> JSONResponse:
+    return JSONResponse(
+        {
+            "success": True,
+            "principals": principals.stats(),
+            "profiles": profiles.stats(),
+            "hub": hub.stats(),
+            "graph": graph.stats(),
+            "channel": channel.stats(),
+            "attacks": attacks.stats(),
+            "reaper": reaper.stats(),
+            "tokens": tokens.stats(),
+            "rate_limits": {path: x.stats() for path, x in limits.items()},
+            "unit_of_work": commit_stats(),
+            "startup": clock.stats(),
+        }
+    )
+
+
+@app.get("/metrics")
+async def metrics_text() -> PlainTextResponse:
+    return PlainTextResponse(
+        metrics.render() + reaper.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
 @app.get("/logout")
 @requires("authenticated")
 async def logout(request: Request) -> JSONResponse:
-    with session_manager() as session:
-        session_info = SessionInfo.query(request.user.token, session)
-        if session_info:
-            request.user.session_info.remove(session_info)
-        session_info.delete(session)
-    del request.cookies["session"]
-    return JSONResponse({"success": True})
+    def end():
+        with session_manager() as session:
+            session_info = SessionInfo.query(request.user.token, session)
+            session_info.delete(session)
+            after_commit(session, lambda: principals.pop(request.user.token))
+            # other workers only know the user, not which token it was
+            after_commit(
+                session, lambda: channel.send("invalidate_user", request.user.id)
+            )
 
+    def revoke(claims: Claims):
+        with session_manager() as session:
+            tokens.persist(session, claims)
 
-TESTS = False
+            def revoked():
+                tokens.denylist.revoke(claims.session_id, claims.expires)
+                principals.pop(request.user.token)
+                channel.send("revoke", claims.session_id, claims.expires)
 
+            after_commit(session, revoked)
 
-def exercise_database():
-    with open("exercises.csv") as file:
-        reader = csv.DictReader(file)
-        exercises = []
-        with session_manager() as session:
-            for row in reader:
-                difficulty = row["difficulty"].lower()
-                tags = row["tags"].split("|")
-                exercise = Exercise.create(row["name"], tags, difficulty)
-                exercise.write(session)
-                exercises.append(exercise)
+    if config.TOKEN_MODE == "signed":
+        claims = tokens.verify(request.user.token)
+        if claims:
+            await run_db(revoke, claims)
+    else:
+        await run_db(end)
+    del request.cookies["session"]
+    return JSONResponse({"success": True})
 
 
-def tests():  # ""tests""
-    global TESTS
-    if TESTS:
+def seed_demo():
+    if User.find(username="john"):
+        # durable database seeded by an earlier run
         return
-    TESTS = True
 
-    exercise_database()
-
-    user = User.register("john", "password")
-    user.write()
-    user2 = User.register("pog", "champ")
-    user2.write()
+    try:
+        user = User.register("john", "password")
+        user.write()
+        user2 = User.register("pog", "champ")
+        user2.write()
+    except IntegrityError:
+        # another worker is seeding the same database
+        return
 
     user = User.find(username="john")
     user2 = User.find(username="pog")
@@ -319,9 +866,22 @@ def tests():  # ""tests""
     user.new_friend(user2.id)
 
     assert user.authenticate("password")
-    assert User.from_db(SessionInfo.find(token)) == user
+    if config.TOKEN_MODE == "signed":
+        assert tokens.verify(token).user_id == user.id
+    else:
+        assert User.from_db(SessionInfo.find(token)) == user
 
 
 if __name__ == "__main__":
-    tests()
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    if config.WORKERS > 1 and SINGLE_CONNECTION:
+        raise SystemExit("WORKERS > 1 needs a shared DATABASE_URL")
+    if (
+        config.WORKERS > 1
+        and config.TOKEN_MODE == "signed"
+        and not config.SECRET_KEY_SET
+    ):
+        raise SystemExit("TOKEN_MODE=signed with WORKERS > 1 needs a SECRET_KEY")
+    if config.ATTACK_LOG and (config.WORKERS > 1 or SINGLE_CONNECTION):
+        raise SystemExit("ATTACK_LOG needs a single worker and a file DATABASE_URL")
+    # workers import the app themselves
+    uvicorn.run("app:app", host=config.HOST, port=config.PORT, workers=config.WORKERS)
@@ -0,0 +1,402 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import struct
+from time import time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import config
+
+# session id, user id, damage, unix time, whether it killed the boss
+RECORD = struct.Struct("<IIqd?")
+
+_LOG_NAME = re.compile(r"attacks\.(\d+)\.log$")
+
+logger = logging.getLogger(__name__)
+
+
+class Party(NamedTuple):
+    name: str
+    start_time: float
+    tag: str
+    # boss health in the gamesessions row, which the log leaves alone
+    health: int
+    user_ids: Tuple[int, ...]
+    usernames: Tuple[str, ...]
+
+
+class AttackLog:
+    """
+    Attacks as fixed-width records appended to a log file instead of row
+    updates. Boss health and damage stats are materialized in memory from
+    the log, and snapshotted every `snapshot_interval` seconds, when a new
+    log file (generation) is started and the old one deleted. At startup
+    `recover()` loads the last snapshot and replays the log written since.
+
+    Appends made while a write is in flight are written together by the
+    next one (group commit); an attack is only answered once its record is
+    written. Everything but the file writes happens on the event loop, so
+    only one attack can see a boss die. Boss health lives in this process,
+    which makes the log incompatible with several workers.
+    """
+
+    def __init__(self, directory: str, snapshot_interval: float, fsync: bool):
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+        self.appended = 0
+        self.writes = 0
+        self.snapshots = 0
+        self.errors = 0
+        # session id -> damage dealt, and by member
+        self.dealt: Dict[int, int] = {}
+        self.by_member: Dict[int, Dict[int, int]] = {}
+        # user id -> [damage, attacks, kills]
+        self.totals: Dict[int, List[int]] = {}
+        self._parties: Dict[int, Party] = {}
+        # sessions whose boss died but whose payout failed, retried before
+        # each snapshot
+        self._unpaid: Set[int] = set()
+        self._generation = 0
+        self._fd: Optional[int] = None
+        self._buffer = bytearray()
+        self._written: Optional[asyncio.Future] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def stats(self) -> Dict:
+        return {
+            "appended": self.appended,
+            "writes": self.writes,
+            "snapshots": self.snapshots,
+            "errors": self.errors,
+            "generation": self._generation,
+            "sessions": len(self.dealt),
+        }
+
+    def health(self, session_id: int, health: int) -> int:
+        """
+        Boss health of a session whose row says `health`.
+        """
+        return health - self.dealt.get(session_id, 0)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _log_path(self, generation: int) -> str:
+        return self._path(f"attacks.{generation:08d}.log")
+
+    def _apply(self, session_id: int, user_id: int, damage: int, killed: bool):
+        self.dealt[session_id] = self.dealt.get(session_id, 0) + damage
+        members = self.by_member.setdefault(session_id, {})
+        members[user_id] = members.get(user_id, 0) + damage
+        totals = self.totals.setdefault(user_id, [0, 0, 0])
+        totals[0] += damage
+        totals[1] += 1
+        totals[2] += killed
+
+    def forget(self, *session_ids: int):
+        """
+        Drop sessions that were deleted, killed or expired. Safe to call from
+        any thread, the state is only changed on the event loop.
+        """
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is not loop:
+                loop.call_soon_threadsafe(self.forget, *session_ids)
+                return
+        for session_id in session_ids:
+            self._parties.pop(session_id, None)
+            self.dealt.pop(session_id, None)
+            self.by_member.pop(session_id, None)
+
+    def recover(self):
+        """
+        Load the last snapshot and replay the logs written after it, then
+        pay out sessions whose boss is dead but which weren't paid before the
+        process stopped and forget sessions that are gone. Ends with a fresh
+        snapshot and log generation. Blocking, called at startup.
+        """
+        from database import GameSession, session_manager
+
+        os.makedirs(self.directory, exist_ok=True)
+        generation = 0
+        try:
+            with open(self._path("snapshot.json")) as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            state = None
+        if state:
+            generation = state["generation"]
+            self.dealt = {int(k): v for k, v in state["dealt"].items()}
+            self.by_member = {
+                int(k): {int(u): v for u, v in members.items()}
+                for k, members in state["by_member"].items()
+            }
+            self.totals = {int(k): v for k, v in state["totals"].items()}
+
+        logs = sorted(
+            (int(match.group(1)), name)
+            for match, name in (
+                (_LOG_NAME.match(name), name) for name in os.listdir(self.directory)
+            )
+            if match
+        )
+        for log_generation, name in logs:
+            if log_generation < generation:
+                continue
+            with open(self._path(name), "rb") as file:
+                data = file.read()
+            # a record torn by a crash mid-write was never acknowledged
+            data = data[: len(data) - len(data) % RECORD.size]
+            for session_id, user_id, damage, _, kill in RECORD.iter_unpack(data):
+                self._apply(session_id, user_id, damage, kill)
+
+        # judged by health rather than by the logged kills, which miss a kill
+        # that made it into a snapshot but not into the database
+        with session_manager() as session:
+            live = GameSession.boss_health(session, self.dealt)
+            self.forget(*(self.dealt.keys() - live.keys()))
+            for session_id, health in live.items():
+                if self.health(session_id, health) <= 0:
+                    GameSession.kill(session, session_id)
+                    self.forget(session_id)
+
+        generation = max([generation, *(g for g, _ in logs)]) + 1
+        self._save(generation, self._state())
+        self._open(generation)
+        for log_generation, name in logs:
+            os.remove(self._path(name))
+
+    def _prepare(self):
+        # made on the event loop that uses them
+        loop = self._loop = asyncio.get_running_loop()
+        if self._written is None or self._written.get_loop() is not loop:
+            self._lock = asyncio.Lock()
+            self._written = loop.create_future()
+
+    def start(self):
+        self._prepare()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # a clean shutdown restarts from the snapshot alone
+        await self.snapshot()
+        os.close(self._fd)
+        self._fd = None
+
+    async def party(self, session_id: int) -> Optional[Party]:
+        from database import GameSession, session_manager
+        from executor import run_db
+
+        party = self._parties.get(session_id)
+        if party is not None:
+            return party
+
+        def load() -> Optional[Party]:
+            with session_manager() as session:
+                found = GameSession.party(session, session_id)
+            if found is None:
+                return
+            row, members = found
+            return Party(
+                row.name,
+                row.startTime,
+                row.tag,
+                row.bossHealth,
+                tuple(user_id for user_id, _ in members),
+                tuple(username for _, username in members),
+            )
+
+        party = await run_db(load)
+        if party is None:
+            return
+        return self._parties.setdefault(session_id, party)
+
+    async def attack(
+        self, session_id: int, user_id: int, damage: int
+    ) -> "Optional[Tuple[Dict, List[int]]]":
+        """
+        Log an attack, with the same result as `GameSession.attack`: the
+        session's state (empty once killed) and the party's user ids, or
+        None if there's no live session with this id.
+        """
+        from channel import channel
+        from database import SESSION_LIFETIME, GameSession
+        from executor import run_db
+
+        party = await self.party(session_id)
+        if party is None or time() - party.start_time >= SESSION_LIFETIME:
+            return
+        health = self.health(session_id, party.health)
+        if health <= 0:
+            return
+        killed = damage >= health
+        self._prepare()
+        # packed first, so a record that doesn't fit leaves the state alone
+        record = RECORD.pack(session_id, user_id, damage, time(), killed)
+        self._apply(session_id, user_id, damage, killed)
+        self._buffer += record
+        self.appended += 1
+        written = self._written
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._drain())
+        # shared by the whole batch, a cancelled request must not cancel it
+        await asyncio.shield(written)
+
+        user_ids = list(party.user_ids)
+        if killed:
+            try:
+                await run_db(self._kill, session_id)
+            except Exception:
+                # logged, so it's paid by the retry or at the next recovery
+                logger.exception("Paying out session %s failed", session_id)
+                self._unpaid.add(session_id)
+            else:
+                self.forget(session_id)
+            return {}, user_ids
+        channel.broadcast("bump", user_ids, "sessions")
+        state = GameSession.format(
+            session_id,
+            party.name,
+            party.health,
+            party.start_time,
+            list(party.usernames),
+            party.tag,
+        )
+        return state, user_ids
+
+    def _kill(self, session_id: int):
+        from database import GameSession, session_manager, unit_of_work
+
+        # in a transaction of its own rather than the request's unit of work,
+        # so the payout is committed (or has failed) by the time this returns
+        token = unit_of_work.set(None)
+        try:
+            with session_manager() as session:
+                GameSession.kill(session, session_id)
+        finally:
+            unit_of_work.reset(token)
+
+    async def _settle(self):
+        from executor import run_db
+
+        for session_id in list(self._unpaid):
+            try:
+                await run_db(self._kill, session_id)
+            except Exception:
+                logger.exception("Paying out session %s failed", session_id)
+                continue
+            self._unpaid.discard(session_id)
+            self.forget(session_id)
+
+    async def _drain(self):
+        async with self._lock:
+            while self._buffer:
+                await self._write_buffer()
+
+    async def _write_buffer(self):
+        from executor import run_db
+
+        if not self._buffer:
+            return
+        data, written = bytes(self._buffer), self._written
+        self._buffer.clear()
+        self._written = asyncio.get_running_loop().create_future()
+        try:
+            await run_db(self._write, self._fd, data)
+        except OSError as e:
+            # the attacks stay applied in memory, the next snapshot has them
+            written.set_exception(e)
+            return
+        self.writes += 1
+        written.set_result(None)
+
+    def _write(self, fd: int, data: bytes):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+        if self.fsync:
+            os.fsync(fd)
+
+    async def snapshot(self):
+        """
+        Save the materialized state and move on to a new log generation.
+        """
+        from executor import run_db
+
+        self._prepare()
+        async with self._lock:
+            # the state and the buffer are taken together, so the buffered
+            # records go to the old generation and into the snapshot
+            state = self._state()
+            await self._write_buffer()
+            generation = self._generation + 1
+            await run_db(self._save, generation, state)
+            old, previous = self._fd, self._generation
+            self._open(generation)
+            os.close(old)
+            os.remove(self._log_path(previous))
+            self.snapshots += 1
+        if self._buffer:
+            self._writer = asyncio.ensure_future(self._drain())
+
+    def _state(self) -> Dict:
+        return {
+            "dealt": dict(self.dealt),
+            "by_member": {k: dict(v) for k, v in self.by_member.items()},
+            "totals": {k: list(v) for k, v in self.totals.items()},
+        }
+
+    def _save(self, generation: int, state: Dict):
+        temporary = self._path("snapshot.json.tmp")
+        with open(temporary, "w") as file:
+            json.dump({"generation": generation, **state}, file)
+            file.flush()
+            if self.fsync:
+                os.fsync(file.fileno())
+        os.replace(temporary, self._path("snapshot.json"))
+
+    def _open(self, generation: int):
+        self._fd = os.open(
+            self._log_path(generation), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644
+        )
+        self._generation = generation
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self._settle()
+                await self.snapshot()
+            except Exception:
+                # e.g. a full disk, the log keeps growing until a snapshot
+                # goes through
+                self.errors += 1
+                logger.exception("Snapshot failed")
+
+
+attacks = AttackLog(
+    config.ATTACK_LOG, config.ATTACK_SNAPSHOT_INTERVAL, config.ATTACK_LOG_FSYNC
+)
@@ -0,0 +1,1377 @@
+"""
+In-process benchmarks, run as `python benchmark.py <scenario>`.
+
+Requests are driven straight through the ASGI app, so no sockets or server
+process are involved and the numbers only reflect the application itself.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import tempfile
+from functools import partial
+from http.cookies import SimpleCookie
+from statistics import quantiles
+from time import perf_counter, sleep, time
+from typing import Dict, List, Optional, Tuple
+
+
+class ASGIClient:
+    """
+    Minimal HTTP/1.1 client that calls an ASGI app directly.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.cookies: Dict[str, str] = {}
+        # response headers of the last request, and body bytes received
+        self.headers: Dict[str, str] = {}
+        self.received = 0
+
+    def _scope(self, method: str, path: str, headers: List) -> Dict:
+        path, _, query = path.partition("?")
+        if self.cookies:
+            cookie = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+            headers = [*headers, (b"cookie", cookie.encode())]
+        return {
+            "type": "http",
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": headers,
+            "client": ("127.0.0.1", 0),
+            "server": ("testserver", 80),
+        }
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        body: Optional[Dict] = None,
+        headers: Dict[str, str] = None,
+    ) -> Tuple[int, Dict]:
+        payload = json.dumps(body).encode() if body is not None else b""
+        extra = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+        scope = self._scope(
+            method, path, [(b"content-type", b"application/json"), *extra]
+        )
+        sent = False
+        status = 500
+        chunks = []
+
+        async def receive():
+            nonlocal sent
+            if sent:
+                await asyncio.sleep(3600)
+            sent = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                self.headers = {
+                    k.decode().lower(): v.decode()
+                    for k, v in message.get("headers", [])
+                }
+                for key, value in message.get("headers", []):
+                    if key.lower() == b"set-cookie":
+                        cookie = SimpleCookie(value.decode())
+                        self.cookies.update({k: m.value for k, m in cookie.items()})
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+        data = b"".join(chunks)
+        self.received += len(data)
+        if not self.headers.get("content-type", "").startswith("application/json"):
+            # e.g. /metrics
+            return status, {}
+        return status, json.loads(data) if data else {}
+
+    async def first_event(self, path: str) -> int:
+        """
+        Open a streaming GET, wait for its first body chunk and hang up.
+        """
+        first = asyncio.get_running_loop().create_future()
+        scope = self._scope("GET", path, [])
+        status = 500
+
+        async def receive():
+            await first
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif not first.done():
+                first.set_result(None)
+
+        task = asyncio.ensure_future(self.app(scope, receive, send))
+        await asyncio.wait([first, task], return_when=asyncio.FIRST_COMPLETED)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return status
+
+    async def get(self, path: str, headers: Dict[str, str] = None) -> Tuple[int, Dict]:
+        return await self.request("GET", path, headers=headers)
+
+    async def post(self, path: str, body: Dict) -> Tuple[int, Dict]:
+        return await self.request("POST", path, body)
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict:
+    latencies = sorted(latencies)
+    cuts = quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p95_ms": round(cuts[94] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+    }
+
+
+async def timed(latencies: List[float], call):
+    start = perf_counter()
+    await call
+    latencies.append(perf_counter() - start)
+
+
+async def offload(users: int, rounds: int) -> Dict:
+    """
+    Concurrent logins (password hashing + writes) mixed with cheap /points
+    polls, once with everything inline on the event loop and once with the
+    worker pools.
+    """
+    import config
+    import executor
+    from app import app, seed_demo, startup
+    from hashing import hasher
+    from user import User
+
+    users = users or 32
+    startup()
+    seed_demo()
+    names = [f"bench{i}" for i in range(users)]
+    for name in names:
+        User.register(name, "password").write()
+
+    results = {}
+    for label, threads in (("inline", 0), ("pooled", None)):
+        executor.configure(db_threads=threads, cpu_threads=threads)
+        hasher.workers = config.HASH_WORKERS if threads is None else threads
+        hasher.rejected = 0
+        poller = ASGIClient(app)
+        await poller.post("/login", {"username": "john", "password": "password"})
+        logins, polls = [], []
+
+        async def login(name):
+            client = ASGIClient(app)
+            body = {"username": name, "password": "password"}
+            await timed(logins, client.post("/login", body))
+
+        async def poll(storm: asyncio.Future):
+            # a cheap request should not have to wait behind the login storm
+            while not storm.done():
+                await timed(polls, poller.get("/points"))
+                await asyncio.sleep(0)
+
+        start = perf_counter()
+        for _ in range(rounds):
+            storm = asyncio.gather(*(login(name) for name in names))
+            await asyncio.gather(storm, poll(storm))
+        elapsed = perf_counter() - start
+        results[label] = {
+            "login": summarize(logins, elapsed),
+            "points": summarize(polls, elapsed),
+            "rejected_logins": hasher.rejected,
+        }
+    executor.configure()
+    hasher.shutdown()
+    return results
+
+
+def use_file_database():
+    """
+    Point the app at a throwaway SQLite file unless DATABASE_URL is set. Must
+    run before anything imports database.py.
+    """
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{path}")
+
+
+async def lookup(users: int, rounds: int) -> Dict:
+    """
+    Username and session token lookups against a large users table, with the
+    lookup indexes in place and after dropping them.
+    """
+    use_file_database()
+    from sqlalchemy import text
+
+    from database import _DBUser, engine
+    from migrations import MIGRATIONS, migrate
+    from session import SessionInfo, hash_token
+    from user import User
+
+    users = users or 100_000
+    migrate()
+    engine.execute(
+        _DBUser.__table__.insert(),
+        [{"username": f"user{i}", "hash": "x"} for i in range(users)],
+    )
+    now = time()
+    engine.execute(
+        SessionInfo.__table__.insert(),
+        [
+            {"user_id": i + 1, "token_hash": hash_token(f"token{i}"), "created": now}
+            for i in range(users)
+        ],
+    )
+    token_query = text("SELECT user_id FROM session WHERE token_hash = :hash")
+
+    def measure(samples: int) -> Dict:
+        by_name, by_token = [], []
+        for _ in range(samples):
+            i = random.randrange(users)
+            start = perf_counter()
+            User.find(username=f"user{i}")
+            by_name.append(perf_counter() - start)
+            start = perf_counter()
+            engine.execute(token_query, hash=hash_token(f"token{i}")).scalar()
+            by_token.append(perf_counter() - start)
+        elapsed = sum(by_name) + sum(by_token)
+        return {
+            "user_by_username": summarize(by_name, elapsed),
+            "session_by_token": summarize(by_token, elapsed),
+        }
+
+    results = {"users": users, "indexed": measure(1000 * rounds)}
+    for statement in MIGRATIONS[0][2] + MIGRATIONS[2][2]:
+        if isinstance(statement, str) and " IF NOT EXISTS " in statement:
+            name = statement.split(" IF NOT EXISTS ")[1].split()[0]
+            engine.execute(f"DROP INDEX IF EXISTS {name}")
+    results["unindexed"] = measure(20 * rounds)
+    return results
+
+
+async def attack(users: int, rounds: int) -> Dict:
+    """
+    Many concurrent /attack requests on one boss whose health is exactly the
+    total damage, plus some stragglers after it dies, as row updates and
+    through the attack log. Fails loudly if any damage was lost or the kill
+    paid out anything but exactly once.
+    """
+    use_file_database()
+    from app import app, startup
+    from attacklog import attacks
+    from database import GameSession, _DBUser, session_manager
+    from user import User
+
+    attacks_per_round = users or 2000
+    party = [f"member{i}" for i in range(5)]
+    startup()
+    for name in party:
+        User.register(name, "password").write()
+    clients = [ASGIClient(app) for _ in party]
+    for name, client in zip(party, clients):
+        await client.post("/login", {"username": name, "password": "password"})
+
+    results = {}
+    for mode in ("row_updates", "log"):
+        if mode == "log":
+            attacks.directory = tempfile.mkdtemp()
+            attacks.recover()
+        results[mode] = {}
+        for round in range(rounds):
+            status, body = await clients[0].post(
+                "/create_session",
+                {"users": party[1:], "name": f"raid{round}", "tag": "core"},
+            )
+            with session_manager() as session:
+                game_session = GameSession.find(session, id=body["id"])
+                game_session.bossHealth = attacks_per_round
+                game_session.write(session)
+                before = {u.id: u.points for u in _DBUser.query(session, {})}
+            for client in clients:
+                await client.get("/points")
+            latencies, statuses = [], []
+
+            async def hit(client):
+                start = perf_counter()
+                status, _ = await client.post(
+                    "/attack", {"id": body["id"], "damage": 1}
+                )
+                latencies.append(perf_counter() - start)
+                statuses.append(status)
+
+            stragglers = attacks_per_round // 10
+            start = perf_counter()
+            await asyncio.gather(
+                *(
+                    hit(clients[i % len(clients)])
+                    for i in range(attacks_per_round + stragglers)
+                )
+            )
+            elapsed = perf_counter() - start
+            with session_manager() as session:
+                alive = GameSession.find(session, id=body["id"])
+                gained = {
+                    u.id: u.points - before[u.id]
+                    for u in _DBUser.query(session, {})
+                    if u.username in party
+                }
+            assert alive is None, f"lost damage, boss left at {alive.bossHealth}"
+            assert set(gained.values()) == {100}, f"payout not exactly once: {gained}"
+            assert (
+                statuses.count(200) == attacks_per_round
+            ), "an attack after the kill landed"
+            results[mode][f"round{round}"] = summarize(latencies, elapsed)
+    results["log_stats"] = attacks.stats()
+    await attacks.snapshot()
+    attacks.directory = ""
+    return results
+
+
+async def principal(users: int, rounds: int) -> Dict:
+    """
+    Time and memory allocated per authenticated request to build the
+    principal from a session token, lazily and with the relationship
+    collections loaded eagerly as `User.from_db` used to.
+    """
+    use_file_database()
+    import tracemalloc
+
+    from database import GameSession, _DBUser, engine, session_users
+    from friend import Friend
+    from migrations import migrate
+    from session import SessionInfo, hash_token
+
+    users = users or 1000
+    migrate()
+    engine.execute(
+        _DBUser.__table__.insert(),
+        [{"username": f"user{i}", "hash": "x"} for i in range(users)],
+    )
+    now = time()
+    engine.execute(
+        SessionInfo.__table__.insert(),
+        [
+            {"user_id": i + 1, "token_hash": hash_token(f"token{i}"), "created": now}
+            for i in range(users)
+        ],
+    )
+    # a handful of friends and game sessions each
+    engine.execute(
+        Friend.__table__.insert(),
+        [
+            {"user_id": i + 1, "friend_id": (i + k) % users + 1, "confirmed": True}
+            for i in range(users)
+            for k in range(1, 6)
+        ],
+    )
+    engine.execute(
+        GameSession.__table__.insert(),
+        [{"name": f"s{i}", "tag": "core"} for i in range(users)],
+    )
+    engine.execute(
+        session_users.insert(),
+        [
+            {"user_id": i + 1, "session_id": (i + k) % users + 1}
+            for i in range(users)
+            for k in range(3)
+        ],
+    )
+
+    def eager(token: str):
+        user = SessionInfo.find(token)
+        user.session_info, user.friends, user.sessions
+
+    def measure(build, samples: int) -> Dict:
+        latencies = []
+        for _ in range(samples):
+            token = f"token{random.randrange(users)}"
+            start = perf_counter()
+            build(token)
+            latencies.append(perf_counter() - start)
+        tracemalloc.start()
+        for _ in range(samples):
+            build(f"token{random.randrange(users)}")
+        _, peak = tracemalloc.get_traced_memory()
+        allocated = sum(
+            x.size for x in tracemalloc.take_snapshot().statistics("filename")
+        )
+        tracemalloc.stop()
+        return {
+            **summarize(latencies, sum(latencies)),
+            "peak_kib": round(peak / 1024, 1),
+            "retained_bytes_per_request": allocated // samples,
+        }
+
+    return {
+        "users": users,
+        "lazy": measure(SessionInfo.find, 500 * rounds),
+        "eager": measure(eager, 500 * rounds),
+    }
+
+
+async def startup(users: int, rounds: int) -> Dict:
+    """
+    Cold start: importing the app, running its startup phase and serving the
+    first login, plus the exercise catalog stored in bulk against one commit
+    per exercise.
+    """
+    use_file_database()
+    os.environ.setdefault("SEED_DEMO", "1")
+    start = perf_counter()
+    import app as application
+    import catalog
+    from database import Exercise, session_manager
+
+    imported = perf_counter() - start
+    lifespan = application.lifespan(application.app)
+    start = perf_counter()
+    await lifespan.__anext__()
+    started = perf_counter() - start
+    client = ASGIClient(application.app)
+    logins = []
+    for _ in range(rounds):
+        start = perf_counter()
+        status, _ = await client.post(
+            "/login", {"username": "john", "password": "password"}
+        )
+        logins.append(perf_counter() - start)
+        assert status == 200, status
+    await lifespan.aclose()
+
+    current = catalog.catalog()
+    start = perf_counter()
+    catalog.store(current)
+    bulk = perf_counter() - start
+    start = perf_counter()
+    with session_manager() as session:
+        for x in current.exercises:
+            tags = [k for k, v in catalog.LETTER_BITS.items() if x.tags & v]
+            Exercise.create(x.name, tags, x.difficulty).write(session)
+    per_row = perf_counter() - start
+    return {
+        "import_ms": round(imported * 1000, 3),
+        "startup_ms": round(started * 1000, 3),
+        "first_login_ms": round(logins[0] * 1000, 3),
+        "later_login_ms": round(min(logins[1:] or logins) * 1000, 3),
+        "catalog": {
+            "exercises": len(current.exercises),
+            "bulk_ms": round(bulk * 1000, 3),
+            "per_row_ms": round(per_row * 1000, 3),
+        },
+    }
+
+
+class Recorder:
+    """
+    Latencies and status codes per endpoint.
+    """
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.statuses: Dict[str, Dict[int, int]] = {}
+
+    async def call(self, endpoint: str, call) -> Tuple[int, Dict]:
+        start = perf_counter()
+        result = await call
+        self.latencies.setdefault(endpoint, []).append(perf_counter() - start)
+        status = result[0] if isinstance(result, tuple) else result
+        counts = self.statuses.setdefault(endpoint, {})
+        counts[status] = counts.get(status, 0) + 1
+        return result
+
+    async def retry(self, endpoint: str, request) -> Tuple[int, Dict]:
+        """
+        Repeat `request()` while the server answers 503, as a client
+        honouring Retry-After would, only faster.
+        """
+        while True:
+            result = await self.call(endpoint, request())
+            if result[0] != 503:
+                return result
+            await asyncio.sleep(0.05)
+
+    def report(self, elapsed: float) -> Dict:
+        return {
+            endpoint: {
+                **summarize(latencies, elapsed),
+                "statuses": self.statuses[endpoint],
+            }
+            for endpoint, latencies in sorted(self.latencies.items())
+        }
+
+
+def seed(users: int, friends: int, party: int) -> List[List[int]]:
+    """
+    Bulk insert `users` players (password "password", user<i>) with
+    `friends` confirmed friends each and one game session per `party`
+    consecutive players. Returns each user's game session ids by index.
+    """
+    from database import GameSession, _DBUser, engine, session_users
+    from friend import Friend
+    from hashing import context
+
+    hash = context.hash("password")
+    engine.execute(
+        _DBUser.__table__.insert(),
+        [
+            {
+                "id": i + 1,
+                "username": f"user{i}",
+                "hash": hash,
+                "points": random.randrange(1000),
+            }
+            for i in range(users)
+        ],
+    )
+    engine.execute(
+        Friend.__table__.insert(),
+        [
+            {"user_id": i + 1, "friend_id": (i + k) % users + 1, "confirmed": True}
+            for i in range(users)
+            for k in range(1, friends + 1)
+        ],
+    )
+    parties = range(0, users, party)
+    engine.execute(
+        GameSession.__table__.insert(),
+        [
+            {"id": n + 1, "name": f"party{n}", "tag": "core", "bossHealth": 10**6}
+            for n, _ in enumerate(parties)
+        ],
+    )
+    engine.execute(
+        session_users.insert(),
+        [
+            {"user_id": i + 1, "session_id": n + 1}
+            for n, first in enumerate(parties)
+            for i in range(first, min(first + party, users))
+        ],
+    )
+    return [[i // party + 1] for i in range(users)]
+
+
+async def suite(users: int, rounds: int) -> Dict:
+    """
+    Every endpoint under a mixed load: synthetic players, friendships and
+    parties are seeded, then a login storm, concurrent players polling,
+    attacking and shopping (with row updates, then the attack log), friend
+    requests, registrations, live streams and logouts. Reports per endpoint
+    and phase.
+    """
+    use_file_database()
+    from app import app, startup
+    from attacklog import attacks
+    from migrations import migrate
+
+    users = users or 1000
+    concurrency = min(users, 64)
+    friends, party = 5, 4
+    migrate()
+    start = perf_counter()
+    sessions = seed(users, friends, party)
+    seeded = perf_counter() - start
+    startup()
+    clients = [ASGIClient(app) for _ in range(concurrency)]
+    results = {
+        "users": users,
+        "concurrency": concurrency,
+        "seed_ms": round(seeded * 1000, 3),
+    }
+
+    # every client logs in at once, retrying while hashing is saturated
+    recorder = Recorder()
+    start = perf_counter()
+    await asyncio.gather(
+        *(
+            recorder.retry(
+                "POST /login",
+                partial(
+                    client.post,
+                    "/login",
+                    {"username": f"user{i}", "password": "password"},
+                ),
+            )
+            for i, client in enumerate(clients)
+        )
+    )
+    results["login_storm"] = recorder.report(perf_counter() - start)
+
+    def mix(i: int) -> List[Tuple[str, str, Optional[Dict]]]:
+        target = f"user{random.randrange(users)}"
+        own = random.choice(sessions[i])
+        calls = [
+            ("GET", "/sessions", None),
+            ("GET", "/sessions", None),
+            ("GET", "/friends_list", None),
+            ("GET", "/friends_list", None),
+            ("POST", "/attack", {"id": own, "damage": 1}),
+            ("POST", "/attack", {"id": own, "damage": 1}),
+            ("GET", "/points", None),
+            ("GET", "/leaderboard", None),
+            ("GET", "/leaderboard?friends=true", None),
+            ("GET", "/rank", None),
+            ("POST", "/avatar", {"username": target}),
+            ("POST", "/buy", {"avatar": "cat", "price": 1}),
+            (
+                "POST",
+                "/create_session",
+                {"users": [f"user{(i + 1) % users}"], "name": "raid", "tag": "core"},
+            ),
+            (
+                "POST",
+                "/create_sessions",
+                {
+                    "sessions": [
+                        {"users": [], "name": f"event{n}", "tag": "cardiovascular"}
+                        for n in range(3)
+                    ]
+                },
+            ),
+            ("GET", "/friend_suggestions", None),
+            (
+                "POST",
+                "/profiles",
+                {"ids": [random.randrange(1, users + 1)], "usernames": [target]},
+            ),
+            ("GET", "/exercises/search?prefix=pu", None),
+            ("POST", "/workout_plan", {"tags": ["core"], "minutes": 20}),
+            ("GET", "/cache_stats", None),
+            ("GET", "/metrics", None),
+        ]
+        if attacks.enabled:
+            calls += [
+                ("GET", "/damage", None),
+                ("GET", f"/sessions/{own}/damage", None),
+            ]
+        return calls
+
+    async def play(i: int, client: ASGIClient, recorder: Recorder):
+        for _ in range(rounds * 20):
+            method, path, body = random.choice(mix(i))
+            route = re.sub(r"/\d+", "/{id}", path.partition("?")[0])
+            endpoint = f"{method} {route}"
+            await recorder.call(endpoint, client.request(method, path, body))
+
+    for phase in ("mixed", "mixed_log"):
+        if phase == "mixed_log":
+            attacks.directory = tempfile.mkdtemp()
+            attacks.recover()
+        recorder = Recorder()
+        start = perf_counter()
+        await asyncio.gather(*(play(i, c, recorder) for i, c in enumerate(clients)))
+        results[phase] = recorder.report(perf_counter() - start)
+
+    # the first half befriends the second, which accepts or denies
+    recorder = Recorder()
+    half = concurrency // 2
+    start = perf_counter()
+    await asyncio.gather(
+        *(
+            recorder.call(
+                "POST /add_friend",
+                clients[i].post("/add_friend", {"username": f"user{i + half}"}),
+            )
+            for i in range(half)
+        )
+    )
+    await asyncio.gather(
+        *(
+            recorder.call(
+                "POST /accept_friend" if i % 2 else "POST /deny_friend",
+                clients[i + half].post(
+                    "/accept_friend" if i % 2 else "/deny_friend",
+                    {"username": f"user{i}"},
+                ),
+            )
+            for i in range(half)
+        )
+    )
+    await asyncio.gather(
+        *(
+            recorder.retry(
+                "POST /register",
+                partial(
+                    ASGIClient(app).post,
+                    "/register",
+                    {"username": f"new{i}", "password": "password"},
+                ),
+            )
+            for i in range(concurrency)
+        )
+    )
+    await asyncio.gather(
+        *(
+            recorder.call("GET /sessions/stream", c.first_event("/sessions/stream"))
+            for c in clients
+        )
+    )
+    await asyncio.gather(
+        *(recorder.call("GET /logout", c.get("/logout")) for c in clients)
+    )
+    results["social"] = recorder.report(perf_counter() - start)
+    await attacks.snapshot()
+    attacks.directory = ""
+    return results
+
+
+async def etag(users: int, rounds: int) -> Dict:
+    """
+    A client polling /friends_list, /sessions, /points and /avatar, always
+    fetching everything and revalidating with If-None-Match.
+    """
+    use_file_database()
+    from app import app, startup
+    from migrations import migrate
+
+    users = users or 1000
+    migrate()
+    seed(users, friends=50, party=4)
+    startup()
+    client = ASGIClient(app)
+    await client.post("/login", {"username": "user0", "password": "password"})
+    polls = [
+        ("GET", "/friends_list", None),
+        ("GET", "/sessions", None),
+        ("GET", "/points", None),
+        ("POST", "/avatar", {"username": "user1"}),
+    ]
+    results = {}
+    for method, path, body in polls:
+        results[path] = {}
+        for label in ("unconditional", "conditional"):
+            await client.request(method, path, body)
+            headers = {"If-None-Match": client.headers["etag"]}
+            if label == "unconditional":
+                headers = None
+            latencies, statuses = [], set()
+            client.received = 0
+            start = perf_counter()
+            for _ in range(200 * rounds):
+                begin = perf_counter()
+                status, _ = await client.request(method, path, body, headers)
+                latencies.append(perf_counter() - begin)
+                statuses.add(status)
+            results[path][label] = {
+                **summarize(latencies, perf_counter() - start),
+                "statuses": sorted(statuses),
+                "bytes_per_request": client.received // len(latencies),
+            }
+    return results
+
+
+async def tokens(users: int, rounds: int) -> Dict:
+    """
+    Resolving a session token without a cached principal: a session table
+    lookup against verifying a signed token, the latter with a denylist of
+    100k revoked sessions.
+    """
+    use_file_database()
+    from database import engine
+    from migrations import migrate
+    from session import SessionInfo, hash_token
+    from tokens import tokens
+
+    users = users or 10_000
+    migrate()
+    seed(users, friends=0, party=users)
+    now = time()
+    engine.execute(
+        SessionInfo.__table__.insert(),
+        [
+            {"user_id": i + 1, "token_hash": hash_token(f"token{i}"), "created": now}
+            for i in range(users)
+        ],
+    )
+    signed = [tokens.issue(i + 1) for i in range(users)]
+    for _ in range(100_000):
+        tokens.revoke(tokens.issue(1))
+
+    def measure(resolve, pick) -> Dict:
+        latencies = []
+        for _ in range(1000 * rounds):
+            token = pick()
+            start = perf_counter()
+            assert resolve(token)
+            latencies.append(perf_counter() - start)
+        return summarize(latencies, sum(latencies))
+
+    return {
+        "users": users,
+        "database": measure(
+            SessionInfo.find, lambda: f"token{random.randrange(users)}"
+        ),
+        "signed": measure(tokens.verify, lambda: random.choice(signed)),
+        "revoked": len(tokens.denylist),
+    }
+
+
+async def session_store(users: int, rounds: int) -> Dict:
+    """
+    The session table at scale (1M rows by default, a tenth of them
+    expired): token lookups by digest, logins that enforce the per-user cap,
+    and batched pruning of the expired rows.
+    """
+    use_file_database()
+    import config
+    from database import engine
+    from migrations import migrate
+    from reaper import prune
+    from session import SessionInfo, hash_token
+    from user import User
+
+    sessions = users or 1_000_000
+    players = max(sessions // 100, 1)
+    migrate()
+    seed(players, friends=0, party=players)
+    now = time()
+    start = perf_counter()
+    for first in range(0, sessions, 100_000):
+        engine.execute(
+            SessionInfo.__table__.insert(),
+            [
+                {
+                    "user_id": i % players + 1,
+                    "token_hash": hash_token(f"token{i}"),
+                    # every tenth session has outlived TOKEN_LIFETIME
+                    "created": now - (config.TOKEN_LIFETIME + 1 if i % 10 == 0 else i),
+                }
+                for i in range(first, min(first + 100_000, sessions))
+            ],
+        )
+    inserted = perf_counter() - start
+
+    lookups = []
+    for _ in range(1000 * rounds):
+        i = random.randrange(sessions)
+        start = perf_counter()
+        user = SessionInfo.find(f"token{i}")
+        lookups.append(perf_counter() - start)
+        assert (user is None) == (i % 10 == 0)
+
+    logins = []
+    for i in range(100 * rounds):
+        user = User.find(id=i % players + 1)
+        start = perf_counter()
+        user.new_token()
+        logins.append(perf_counter() - start)
+
+    start = perf_counter()
+    pruned = 0
+    while True:
+        deleted = prune(config.REAPER_BATCH)
+        pruned += deleted
+        if deleted < config.REAPER_BATCH:
+            break
+    pruning = perf_counter() - start
+    remaining = engine.execute("SELECT COUNT(*) FROM session").scalar()
+    return {
+        "sessions": sessions,
+        "insert_ms": round(inserted * 1000, 3),
+        "lookup": summarize(lookups, sum(lookups)),
+        "login_with_cap": summarize(logins, sum(logins)),
+        "prune": {
+            "pruned": pruned,
+            "rows_per_second": round(pruned / pruning, 1),
+            "remaining": remaining,
+        },
+    }
+
+
+async def ratelimit(users: int, rounds: int) -> Dict:
+    """
+    The /login limiter under a stream of distinct client addresses (1M by
+    default) arriving at 10k per second of simulated time: the cost of a
+    check, and how many buckets and how much memory stay live as idle ones
+    are dropped. One in a hundred requests comes from a single client that
+    keeps hitting the limit.
+    """
+    import tracemalloc
+
+    import config
+    from ratelimit import RateLimiter
+
+    clients = users or 1_000_000
+    rate, burst = config.RATE_LIMITS["/login"]
+
+    def run(traced: bool) -> Dict:
+        limiter = RateLimiter(rate, burst, config.RATE_LIMIT_KEYS)
+        latencies = []
+        peak = 0
+        if traced:
+            tracemalloc.start()
+        for i in range(clients):
+            key = "10.0.0.1" if i % 100 == 0 else f"192.168.{i >> 16}.{i & 0xFFFF}"
+            if traced:
+                limiter.acquire(key, i / 10_000)
+                continue
+            start = perf_counter()
+            limiter.acquire(key, i / 10_000)
+            latencies.append(perf_counter() - start)
+            peak = max(peak, len(limiter))
+        if traced:
+            _, memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return {"peak_kib": round(memory / 1024, 1)}
+        return {
+            "check": summarize(latencies, sum(latencies)),
+            "peak_buckets": peak,
+            **limiter.stats(),
+        }
+
+    return {
+        "clients": clients,
+        "rate": rate,
+        "burst": burst,
+        **run(traced=False),
+        **run(traced=True),
+    }
+
+
+def _http_client(
+    port: int, cookie: Dict[str, str], start: float, until: float
+) -> List[float]:
+    """
+    One load generating process for `workers`: cycle through read endpoints
+    on a keep-alive connection from `start` to `until`.
+    """
+    from http.client import HTTPConnection
+
+    connection = HTTPConnection("127.0.0.1", port)
+    paths = ["/points", "/rank", "/leaderboard", "/sessions"]
+    latencies = []
+    sleep(max(start - time(), 0))
+    while time() < until:
+        start = perf_counter()
+        connection.request("GET", paths[len(latencies) % 4], headers=cookie)
+        connection.getresponse().read()
+        latencies.append(perf_counter() - start)
+    return latencies
+
+
+def _http_login(connection, username: str) -> Dict[str, str]:
+    body = json.dumps({"username": username, "password": "password"})
+    while True:
+        connection.request(
+            "POST", "/login", body, headers={"Content-Type": "application/json"}
+        )
+        response = connection.getresponse()
+        response.read()
+        if response.status != 503:
+            break
+    cookie = SimpleCookie(response.getheader("Set-Cookie"))
+    return {"Cookie": f"session={cookie['session'].value}"}
+
+
+def _coherence(port: int, username: str, session_id: int) -> Dict:
+    """
+    How long after a boss kill through one worker every worker reports the
+    party's new points, each GET on a fresh connection so they spread over
+    the workers. Gives up after two seconds.
+    """
+    from http.client import HTTPConnection
+
+    def points() -> int:
+        connection = HTTPConnection("127.0.0.1", port)
+        connection.request("GET", "/points", headers=cookie)
+        points = json.loads(connection.getresponse().read())["points"]
+        connection.close()
+        return points
+
+    cookie = _http_login(HTTPConnection("127.0.0.1", port), username)
+    # cache the principal in every worker
+    before = [points() for _ in range(50)][-1]
+    connection = HTTPConnection("127.0.0.1", port)
+    connection.request(
+        "POST",
+        "/attack",
+        json.dumps({"id": session_id, "damage": 10**7}),
+        headers={**cookie, "Content-Type": "application/json"},
+    )
+    connection.getresponse().read()
+    killed = perf_counter()
+    stale, settled = 0, 0.0
+    while perf_counter() - killed < 2:
+        if points() == before:
+            stale += 1
+            settled = perf_counter() - killed
+    return {"stale_reads": stale, "settled_ms": round(settled * 1000, 3)}
+
+
+async def workers(users: int, rounds: int) -> Dict:
+    """
+    `python app.py` over real sockets with 1, 2 and 4 worker processes
+    sharing a file database: throughput of `users` client processes (8 by
+    default) polling read endpoints, and how long a change made through one
+    worker takes to reach the others, with and without the database channel.
+    Throughput only grows with free cores.
+    """
+    import signal
+    import subprocess
+    import sys
+    from http.client import HTTPConnection
+    from multiprocessing import Pool
+    from socket import create_connection
+
+    use_file_database()
+    from migrations import migrate
+
+    clients = users or 8
+    migrate()
+    seed(max(clients, 4 * 8), friends=0, party=4)
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    runs = [(n, "database") for n in (1, 2, 4)] + [(4, "local")]
+    for run, (n, channel) in enumerate(runs):
+        port = 18080 + run
+        server = subprocess.Popen(
+            [sys.executable, "app.py"],
+            cwd=here,
+            env={
+                **os.environ,
+                "WORKERS": str(n),
+                "CHANNEL": channel,
+                "PORT": str(port),
+            },
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            # uvicorn only stops its workers along with their process group
+            start_new_session=True,
+        )
+        try:
+            while True:
+                try:
+                    create_connection(("127.0.0.1", port)).close()
+                    break
+                except OSError:
+                    await asyncio.sleep(0.1)
+            # let every worker finish its startup
+            await asyncio.sleep(2)
+            cookies = [
+                _http_login(HTTPConnection("127.0.0.1", port), f"user{i}")
+                for i in range(clients)
+            ]
+            # once every client process is up
+            start = time() + 1
+            elapsed = rounds * 2
+            with Pool(clients) as pool:
+                latencies = pool.starmap(
+                    _http_client,
+                    [(port, cookie, start, start + elapsed) for cookie in cookies],
+                )
+            coherence = _coherence(port, f"user{4 * run}", run + 1)
+        finally:
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait()
+        results[f"{n}_workers_{channel}"] = {
+            "reads": summarize([x for xs in latencies for x in xs], elapsed),
+            **coherence,
+        }
+    return {"clients": clients, "cores": os.cpu_count(), **results}
+
+
+async def friend_graph(users: int, rounds: int) -> Dict:
+    """
+    Friendship checks, mutual friend counts and friend-of-friend suggestions
+    from the in-memory graph (50k users by default, ~20 random friends each
+    plus one celebrity everybody befriended), against the suggestion query
+    in SQL.
+    """
+    use_file_database()
+    from sqlalchemy import text
+
+    from database import engine
+    from friend import Friend
+    from graph import graph
+    from migrations import migrate
+
+    users = users or 50_000
+    migrate()
+    seed(users, friends=0, party=users)
+    edges = {
+        (i, j)
+        for i in range(2, users + 1)
+        for j in random.sample(range(2, users + 1), 10)
+        if i != j
+    }
+    edges = {(i, j) for i, j in edges if (j, i) not in edges}
+    edges |= {(i, 1) for i in range(2, users + 1)}
+    engine.execute(
+        Friend.__table__.insert(),
+        [{"user_id": i, "friend_id": j, "confirmed": True} for i, j in edges],
+    )
+
+    start = perf_counter()
+    graph.load(
+        engine.execute(
+            text("SELECT user_id, friend_id, confirmed FROM friends")
+        ).fetchall()
+    )
+    loaded = perf_counter() - start
+
+    def measure(call, pick, n: int) -> Dict:
+        latencies = []
+        for _ in range(n * rounds):
+            args = pick()
+            start = perf_counter()
+            call(*args)
+            latencies.append(perf_counter() - start)
+        return summarize(latencies, sum(latencies))
+
+    def someone():
+        return random.randrange(2, users + 1)
+
+    suggest_sql = text("""
+        WITH edges(a, b) AS (
+            SELECT user_id, friend_id FROM friends WHERE confirmed
+            UNION ALL SELECT friend_id, user_id FROM friends WHERE confirmed
+        )
+        SELECT theirs.b, COUNT(*) AS mutual
+        FROM edges mine JOIN edges theirs ON theirs.a = mine.b
+        WHERE mine.a = :id AND theirs.b != :id
+          AND theirs.b NOT IN (SELECT b FROM edges WHERE a = :id)
+        GROUP BY theirs.b ORDER BY mutual DESC, theirs.b LIMIT 10
+        """)
+    return {
+        "users": users,
+        "friendships": len(edges),
+        "load_ms": round(loaded * 1000, 3),
+        "are_friends": measure(
+            graph.are_friends, lambda: (someone(), someone()), 10_000
+        ),
+        "mutual": measure(graph.mutual, lambda: (someone(), someone()), 10_000),
+        "suggest": measure(graph.suggest, lambda: (someone(), 10), 100),
+        "suggest_celebrity": measure(graph.suggest, lambda: (1, 10), 10),
+        "suggest_sql": measure(
+            lambda id: engine.execute(suggest_sql, id=id).fetchall(),
+            lambda: (someone(),),
+            3,
+        ),
+    }
+
+
+async def profiles(users: int, rounds: int) -> Dict:
+    """
+    Rendering a 50 member friends screen: one /avatar per member against a
+    single /profiles call, with a cold and a warm profile cache. Reports
+    requests, queries and time per screen.
+    """
+    use_file_database()
+    from sqlalchemy import event
+
+    from app import app, startup
+    from cache import profiles as cache
+    from database import engine
+    from migrations import migrate
+
+    users = users or 10_000
+    migrate()
+    seed(users, friends=0, party=4)
+    startup()
+    client = ASGIClient(app)
+    await client.post("/login", {"username": "user0", "password": "password"})
+    queries = 0
+
+    def count(*_):
+        nonlocal queries
+        queries += 1
+
+    event.listen(engine, "before_cursor_execute", count)
+
+    async def per_member(members: List[str]):
+        for username in members:
+            await client.post("/avatar", {"username": username})
+        return len(members)
+
+    async def batched(members: List[str]):
+        await client.post("/profiles", {"usernames": members})
+        return 1
+
+    results = {}
+    for label, render in (("per_member", per_member), ("batched", batched)):
+        for state in ("cold", "warm"):
+            latencies, requests, screen_queries = [], 0, 0
+            for _ in range(20 * rounds):
+                members = [f"user{random.randrange(users)}" for _ in range(50)]
+                if state == "warm":
+                    await batched(members)
+                else:
+                    cache.clear()
+                queries = 0
+                start = perf_counter()
+                requests += await render(members)
+                latencies.append(perf_counter() - start)
+                screen_queries += queries
+            results[f"{label}_{state}"] = {
+                **summarize(latencies, sum(latencies)),
+                "requests_per_screen": requests / len(latencies),
+                "queries_per_screen": screen_queries / len(latencies),
+            }
+    event.remove(engine, "before_cursor_execute", count)
+    return results
+
+
+async def workout(users: int, rounds: int) -> Dict:
+    """
+    Workout plans and exercise name searches over exercises.csv and over a
+    synthetic catalog of 50k exercises (`--users` sets its size), against
+    scoring and scanning the catalog in plain Python. `plan_uncached` skips
+    the catalog's memo of finished plans.
+    """
+    import catalog
+    from catalog import DIFFICULTIES, TAG_BITS, Catalog, CatalogExercise
+
+    size = users or 50_000
+    real = catalog.load()
+    words = sorted({word for x in real.exercises for word in x.name.split()})
+    synthetic = [
+        CatalogExercise(
+            " ".join(random.sample(words, 3)),
+            random.choice(DIFFICULTIES),
+            random.randrange(1, 1 << len(TAG_BITS)),
+        )
+        for _ in range(size)
+    ]
+    start = perf_counter()
+    large = Catalog(synthetic)
+    built = perf_counter() - start
+
+    def plan_scan(current: Catalog, mask: int, difficulty: str, slots: int):
+        level = DIFFICULTIES.index(difficulty)
+        scored = sorted(
+            (
+                -bin(x.tags & mask).count("1")
+                + (bin(mask).count("1") + 1)
+                * abs(DIFFICULTIES.index(x.difficulty) - level),
+                i,
+            )
+            for i, x in enumerate(current.exercises)
+            if x.tags & mask
+        )
+        return [current.exercises[i] for _, i in scored[:slots]]
+
+    def search_scan(current: Catalog, prefix: str, limit: int):
+        return [
+            x
+            for x in current.exercises
+            if any(word.startswith(prefix) for word in x.name.lower().split())
+        ][:limit]
+
+    def measure(call, pick) -> Dict:
+        latencies = []
+        for _ in range(200 * rounds):
+            args = pick()
+            start = perf_counter()
+            call(*args)
+            latencies.append(perf_counter() - start)
+        return summarize(latencies, sum(latencies))
+
+    def plan_args():
+        return (
+            random.randrange(1, 1 << len(TAG_BITS)),
+            random.choice(DIFFICULTIES),
+            20,
+        )
+
+    def search_args():
+        return random.choice(words).lower()[:3], 10
+
+    results = {"build_ms": round(built * 1000, 1)}
+    for label, current in (("csv", real), ("synthetic", large)):
+        results[label] = {
+            "exercises": len(current.exercises),
+            "plan": measure(current.plan, plan_args),
+            "plan_uncached": measure(current._plan, plan_args),
+            "plan_scan": measure(partial(plan_scan, current), plan_args),
+            "search": measure(current.search, search_args),
+            "search_scan": measure(partial(search_scan, current), search_args),
+        }
+    return results
+
+
+SCENARIOS = {
+    "attack": attack,
+    "etag": etag,
+    "friend_graph": friend_graph,
+    "lookup": lookup,
+    "offload": offload,
+    "principal": principal,
+    "profiles": profiles,
+    "ratelimit": ratelimit,
+    "session_store": session_store,
+    "startup": startup,
+    "suite": suite,
+    "tokens": tokens,
+    "workers": workers,
+    "workout": workout,
+}
+
+
+def compare(
+    baseline: Dict, current: Dict, tolerance: float, path: str = ""
+) -> List[Tuple[str, float, float]]:
+    """
+    Every p95 in `current` more than `tolerance` above the same entry in
+    `baseline`, as (path, before, after).
+    """
+    regressions = []
+    for key, value in current.items():
+        before = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict) and isinstance(before, dict):
+            regressions += compare(before, value, tolerance, f"{path}/{key}")
+        elif key == "p95_ms" and before and value > before * (1 + tolerance):
+            regressions.append((path, before, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--users", type=int, help="scale, defaults per scenario")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument(
+        "--baseline",
+        help="earlier --output to compare with, exits 1 if any p95 regressed",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative p95 increase over the baseline",
+    )
+    args = parser.parse_args()
+    random.seed(0)
+    # load scenarios replay thousands of logins and attacks per second
+    os.environ.setdefault("RATE_LIMITING", "0")
+    result = {
+        args.scenario: asyncio.run(SCENARIOS[args.scenario](args.users, args.rounds))
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(json.load(file), result, args.tolerance)
+        for path, before, after in regressions:
+            print(f"regression: {path} p95 {before}ms -> {after}ms")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+import config
+
+
+class LRUCache:
+    """
+    Bounded mapping with per-entry expiry and least-recently-used eviction.
+
+    Values read through from the database can lose a race with a write:
+    loaded before it, stored after its invalidation. Such loads pass the
+    `generation` they started at to `set()`, which leaves the value out if
+    it was invalidated since.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = Lock()
+        # bumped by every invalidation; owner -> generation of its last one
+        self.generation = 0
+        self._invalidated: Dict[Hashable, int] = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return
+            expires, value = entry
+            if expires < monotonic():
+                del self._data[key]
+                self._evicted(key, entry)
+                self.misses += 1
+                return
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, loaded: Optional[int] = None) -> bool:
+        """
+        Store `value`, unless it was loaded at generation `loaded` and has
+        been invalidated since. Returns whether it was stored.
+        """
+        with self._lock:
+            if loaded is not None:
+                invalidated = self._invalidated.get(self._owner(key, value), -1)
+                if invalidated > loaded:
+                    return False
+            self._data[key] = (monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            self._stored(key, value)
+            while len(self._data) > self.maxsize:
+                self._evicted(*self._data.popitem(last=False))
+                self.evictions += 1
+            return True
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[1] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _invalidate(self, owner: Hashable):
+        # under the lock
+        self.generation += 1
+        self._invalidated[owner] = self.generation
+
+    def _owner(self, key: Hashable, value: Any) -> Hashable:
+        return key
+
+    def _stored(self, key: Hashable, value: Any):
+        pass
+
+    def _evicted(self, key: Hashable, entry: tuple):
+        pass
+
+
+class PrincipalCache(LRUCache):
+    """
+    Authenticated users keyed by session token, with a reverse index from
+    user id to tokens so writes touching a user can drop all of its entries.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self._tokens: Dict[int, Set[str]] = {}
+
+    def pop(self, token: str) -> "Optional[User]":
+        user = super().pop(token)
+        if user is not None:
+            with self._lock:
+                self._forget(user.id, token)
+        return user
+
+    def invalidate_user(self, *user_ids: int):
+        with self._lock:
+            for user_id in user_ids:
+                self._invalidate(user_id)
+                for token in self._tokens.pop(user_id, ()):
+                    self._data.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tokens.clear()
+
+    def _owner(self, token: str, user: "User") -> int:
+        return user.id
+
+    def _stored(self, token: str, user: "User"):
+        self._tokens.setdefault(user.id, set()).add(token)
+
+    def _evicted(self, token: str, entry: tuple):
+        self._forget(entry[1].id, token)
+
+    def _forget(self, user_id: int, token: str):
+        tokens = self._tokens.get(user_id)
+        if tokens is None:
+            return
+        tokens.discard(token)
+        if not tokens:
+            del self._tokens[user_id]
+
+
+class ProfileCache(LRUCache):
+    """
+    Public profiles ({id, username, avatar, points}) keyed by user id, with
+    an index from username to id so they can be looked up by either.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self._ids: Dict[str, int] = {}
+
+    def get_many(
+        self, ids: Iterable[int], usernames: Iterable[str]
+    ) -> Tuple[List[Dict], List[int], List[str]]:
+        """
+        The cached profiles, then the ids and usernames that weren't cached.
+        """
+        found, missing_ids, missing_usernames = [], [], []
+        for id in ids:
+            profile = self.get(id)
+            if profile is None:
+                missing_ids.append(id)
+            else:
+                found.append(profile)
+        for username in usernames:
+            id = self._ids.get(username)
+            profile = None if id is None else self.get(id)
+            if profile is None:
+                missing_usernames.append(username)
+            else:
+                found.append(profile)
+        return found, missing_ids, missing_usernames
+
+    def invalidate(self, *ids: int):
+        with self._lock:
+            for id in ids:
+                self._invalidate(id)
+        for id in ids:
+            self.pop(id)
+
+    def pop(self, id: int) -> Optional[Dict]:
+        profile = super().pop(id)
+        if profile is not None:
+            with self._lock:
+                self._ids.pop(profile["username"], None)
+        return profile
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._ids.clear()
+
+    def _stored(self, id: int, profile: Dict):
+        self._ids[profile["username"]] = id
+
+    def _evicted(self, id: int, entry: tuple):
+        self._ids.pop(entry[1]["username"], None)
+
+
+principals = PrincipalCache(config.PRINCIPAL_CACHE_SIZE, config.PRINCIPAL_CACHE_TTL)
+profiles = ProfileCache(config.PROFILE_CACHE_SIZE, config.PROFILE_CACHE_TTL)
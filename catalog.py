@@ -0,0 +1,228 @@
+import csv
+import re
+from bisect import bisect_left
+from itertools import cycle, islice
+from os import stat
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+import config
+from database import EXERCISE_TAGS, Exercise, engine
+
+DIFFICULTIES = ("beginner", "intermediate", "advanced")
+LEVELS = {difficulty: i for i, difficulty in enumerate(DIFFICULTIES)}
+
+# one bit per tag column, in the order of EXERCISE_TAGS
+TAG_BITS = {column: 1 << i for i, column in enumerate(EXERCISE_TAGS.values())}
+LETTER_BITS = {letter: TAG_BITS[column] for letter, column in EXERCISE_TAGS.items()}
+
+
+class CatalogExercise(NamedTuple):
+    name: str
+    difficulty: str
+    tags: int
+
+    def as_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "difficulty": self.difficulty,
+            "tags": [column for column, bit in TAG_BITS.items() if self.tags & bit],
+        }
+
+
+def tag_mask(tags: Iterable[str]) -> int:
+    """
+    Bitmask for tag column names (`core`, `balance`, ...); unknown names are
+    ignored.
+    """
+    mask = 0
+    for tag in tags:
+        mask |= TAG_BITS.get(tag, 0)
+    return mask
+
+
+class Catalog:
+    """
+    Immutable view of exercises.csv. Exercise names are precomputed for
+    every (tag mask, difficulty) pair, matching exercises that carry all of
+    the mask's tags, so lookups are a single dict hit.
+
+    Workout plans are scored over a matrix of the exercises' tags, and name
+    prefix searches bisect a sorted list of every word-initial suffix of the
+    names, so neither walks the catalog in Python.
+    """
+
+    def __init__(self, exercises: List[CatalogExercise], mtime: float = 0):
+        self.exercises = tuple(exercises)
+        self.mtime = mtime
+        masks = np.array([x.tags for x in self.exercises], dtype=np.int64)
+        # unknown difficulties are further from any target than the known ones
+        self._levels = np.array(
+            [LEVELS.get(x.difficulty, -len(LEVELS)) for x in self.exercises],
+            dtype=np.float32,
+        )
+        self._tags = (
+            masks[:, None] & np.array(list(TAG_BITS.values()), dtype=np.int64)
+        ).astype(bool)
+        self._matrix = self._tags.astype(np.float32)
+        self._with_tag = [np.flatnonzero(column) for column in self._tags.T]
+
+        names = np.array([x.name for x in self.exercises], dtype=object)
+        self._index: Dict[Tuple[int, str], Tuple[str, ...]] = {}
+        for difficulty in DIFFICULTIES:
+            level = self._levels == LEVELS[difficulty]
+            for mask in range(1, 1 << len(TAG_BITS)):
+                matches = level & (masks & mask == mask)
+                self._index[mask, difficulty] = tuple(names[matches])
+        self._by_tag = {
+            column: self.by_difficulty(bit) for column, bit in TAG_BITS.items()
+        }
+
+        prefixes = sorted(
+            (x.name.lower()[word.start() :], i)
+            for i, x in enumerate(self.exercises)
+            for word in re.finditer(r"\w+", x.name)
+        )
+        self._prefixes = [prefix for prefix, _ in prefixes]
+        self._prefixed = [i for _, i in prefixes]
+        self._plans: Dict[Tuple[int, str, int], Tuple[CatalogExercise, ...]] = {}
+
+    @classmethod
+    def from_csv(cls, path: str) -> "Catalog":
+        with open(path) as file:
+            exercises = [
+                CatalogExercise(
+                    row["name"],
+                    row["difficulty"].lower(),
+                    sum(LETTER_BITS.get(x, 0) for x in set(row["tags"].split("|"))),
+                )
+                for row in csv.DictReader(file)
+            ]
+        return cls(exercises, stat(path).st_mtime)
+
+    def find(self, mask: int, difficulty: str) -> Tuple[str, ...]:
+        return self._index.get((mask, difficulty), ())
+
+    def by_difficulty(self, mask: int) -> Dict[str, Tuple[str, ...]]:
+        return {difficulty: self.find(mask, difficulty) for difficulty in DIFFICULTIES}
+
+    def for_tag(self, tag: str) -> Dict[str, Tuple[str, ...]]:
+        """
+        Exercise names for a game session's tag, keyed by difficulty.
+        """
+        return self._by_tag.get(tag) or self.by_difficulty(0)
+
+    def search(self, prefix: str, limit: int) -> List[CatalogExercise]:
+        """
+        Exercises with a word in their name starting with `prefix`, ignoring
+        case, in the order of the matching words.
+        """
+        prefix = prefix.lower()
+        found: Dict[int, None] = {}
+        for i in range(bisect_left(self._prefixes, prefix), len(self._prefixes)):
+            if len(found) >= limit or not self._prefixes[i].startswith(prefix):
+                break
+            found[self._prefixed[i]] = None
+        return [self.exercises[i] for i in found]
+
+    def plan(
+        self, mask: int, difficulty: str, slots: int
+    ) -> Tuple[CatalogExercise, ...]:
+        """
+        A workout of `slots` exercises for the tags of `mask` (all of them if
+        empty), taking turns between the tags so each is trained about as
+        much.
+
+        Exercises are scored by how many of the wanted tags they train, less
+        a penalty per level away from `difficulty` that outweighs any number
+        of tags, so other levels only fill in for a tag that has run out of
+        exercises at the wanted one. Short catalogs repeat the plan in
+        rounds. Plans are kept, there are only so many different requests.
+        """
+        key = (mask, difficulty, slots)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = self._plans[key] = self._plan(mask, difficulty, slots)
+        return plan
+
+    def _plan(self, mask: int, difficulty: str, slots: int):
+        columns = [i for i, bit in enumerate(TAG_BITS.values()) if mask & bit]
+        columns = columns or list(range(len(TAG_BITS)))
+        wanted = np.zeros(len(TAG_BITS), dtype=np.float32)
+        wanted[columns] = 1
+        distance = np.abs(self._levels - LEVELS[difficulty])
+        scores = self._matrix @ wanted - (len(columns) + 1) * distance
+
+        ranked = []
+        for column in columns:
+            candidates = self._with_tag[column]
+            k = min(slots, len(candidates))
+            if not k:
+                continue
+            best = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+            # best score first, catalog order between equals
+            ranked.append(best[np.lexsort((best, -scores[best]))].tolist())
+
+        picked: Dict[int, None] = {}
+        for turn in range(slots):
+            for exercises in ranked:
+                if turn < len(exercises):
+                    picked.setdefault(exercises[turn])
+            if len(picked) >= slots:
+                break
+        return tuple(self.exercises[i] for i in islice(cycle(picked), slots))
+
+
+def store(current: Catalog):
+    """
+    Replace the exercises table with the catalog's rows, in one transaction
+    and a single executemany.
+    """
+    table = Exercise.__table__
+    rows = [
+        {
+            "name": x.name,
+            "difficulty": x.difficulty,
+            **{column: bool(x.tags & bit) for column, bit in TAG_BITS.items()},
+        }
+        for x in current.exercises
+    ]
+    with engine.begin() as connection:
+        connection.execute(table.delete())
+        if rows:
+            connection.execute(table.insert(), rows)
+
+
+_catalog: Optional[Catalog] = None
+_checked = 0.0
+_lock = Lock()
+
+
+def load(path: str = None) -> Catalog:
+    global _catalog, _checked
+    with _lock:
+        _catalog = Catalog.from_csv(path or config.EXERCISES_CSV)
+        _checked = monotonic()
+        return _catalog
+
+
+def catalog() -> Catalog:
+    """
+    The current catalog. The CSV's mtime is checked at most once every
+    CATALOG_CHECK_INTERVAL seconds and the catalog is rebuilt if it changed.
+    """
+    global _checked
+    if _catalog is None:
+        return load()
+    if monotonic() - _checked > config.CATALOG_CHECK_INTERVAL:
+        _checked = monotonic()
+        try:
+            changed = stat(config.EXERCISES_CSV).st_mtime != _catalog.mtime
+        except OSError:
+            changed = False
+        if changed:
+            return load()
+    return _catalog
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+from collections import deque
+from secrets import token_hex
+from time import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+
+import config
+from cache import principals, profiles
+from graph import graph
+from hub import hub
+from leaderboard import leaderboard
+from tokens import tokens
+from versions import versions
+
+logger = logging.getLogger(__name__)
+
+
+async def _reload_points(user_ids: Iterable[int]):
+    from database import _DBUser, session_manager
+    from executor import run_db
+
+    def load() -> List[Tuple[int, str, int]]:
+        with session_manager() as session:
+            return (
+                session.query(_DBUser.id, _DBUser.username, _DBUser.points)
+                .filter(_DBUser.id.in_(list(user_ids)))
+                .all()
+            )
+
+    leaderboard.update(await run_db(load))
+
+
+class Channel:
+    """
+    Changes to in-process state (cached principals, ETag versions, the
+    leaderboard, live session updates, revoked tokens) that every worker
+    process has to apply, by kind. This one only knows its own process.
+
+    `broadcast()` applies a change here and sends it to the other workers,
+    `send()` only sends it, for changes that were already applied here some
+    other way. Handlers run on the event loop of each receiving worker.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.handlers: Dict[str, Callable] = {
+            "invalidate_user": principals.invalidate_user,
+            "invalidate_profile": profiles.invalidate,
+            "bump": versions.bump,
+            "publish": hub.publish,
+            "revoke": tokens.denylist.revoke,
+            "friend_request": graph.request,
+            "friend_confirm": graph.confirm,
+            "friend_remove": graph.remove,
+            # points are read back from the database, the change that
+            # reached this worker may not be the latest one
+            "points": _reload_points,
+        }
+
+    def broadcast(self, kind: str, *args):
+        self.handlers[kind](*args)
+        self.send(kind, *args)
+
+    def send(self, kind: str, *args):
+        pass
+
+    def prepare(self):
+        """
+        Called at startup before in-process state is loaded from the
+        database, so no change made meanwhile is missed.
+        """
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self) -> Dict:
+        return {"sent": self.sent, "received": self.received}
+
+
+class TableChannel(Channel):
+    """
+    Relays changes through the events table of the shared database. Changes
+    are buffered and written in one batch per `interval`, when this worker
+    also reads everything the others wrote since its last look. Events older
+    than `retention` seconds are deleted along the way.
+
+    Reading by id relies on ids being assigned in commit order, which holds
+    for SQLite where writers take turns.
+    """
+
+    def __init__(self, interval: float, retention: float):
+        super().__init__()
+        self.interval = interval
+        self.retention = retention
+        self.origin = token_hex(8)
+        self._outbox: deque = deque()
+        self._last = 0
+        self._pruned = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def send(self, kind: str, *args):
+        # may be called from any thread, deque appends are atomic
+        self._outbox.append((kind, json.dumps(args, default=list)))
+
+    def prepare(self):
+        from database import engine, events
+
+        self._last = engine.execute(select([func.max(events.c.id)])).scalar() or 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # whatever is still buffered
+        await self.exchange()
+
+    async def exchange(self):
+        from executor import run_db
+
+        outgoing = []
+        while self._outbox:
+            outgoing.append(self._outbox.popleft())
+        try:
+            incoming = await run_db(self._exchange, outgoing)
+        except OperationalError:
+            # e.g. the database stayed locked past busy_timeout, retried on
+            # the next round
+            self._outbox.extendleft(reversed(outgoing))
+            return
+        for kind, args in incoming:
+            handler = self.handlers.get(kind)
+            if handler is None:
+                # from a newer worker during a rolling restart
+                continue
+            self.received += 1
+            # one bad event must not hold up the ones after it
+            try:
+                result = handler(*args)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                logger.exception("Handling %s event failed", kind)
+
+    def _exchange(self, outgoing: List[Tuple[str, str]]) -> List[Tuple[str, list]]:
+        from database import engine, events
+
+        now = time()
+        with engine.begin() as connection:
+            if outgoing:
+                connection.execute(
+                    events.insert(),
+                    [
+                        {
+                            "origin": self.origin,
+                            "kind": kind,
+                            "payload": payload,
+                            "created": now,
+                        }
+                        for kind, payload in outgoing
+                    ],
+                )
+                self.sent += len(outgoing)
+            rows = connection.execute(
+                events.select().where(events.c.id > self._last).order_by(events.c.id)
+            ).fetchall()
+            if now - self._pruned >= self.retention:
+                connection.execute(
+                    events.delete().where(events.c.created < now - self.retention)
+                )
+                self._pruned = now
+        if rows:
+            self._last = rows[-1].id
+        return [
+            (row.kind, json.loads(row.payload))
+            for row in rows
+            if row.origin != self.origin
+        ]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.exchange()
+            except Exception:
+                logger.exception("Exchange failed")
+
+
+channel = (
+    TableChannel(config.CHANNEL_INTERVAL, config.CHANNEL_RETENTION)
+    if config.CHANNEL == "database"
+    else Channel()
+)
@@ -0,0 +1,110 @@
+from os import cpu_count, environ, path
+from secrets import token_hex
+
+
+def _int(name: str, default: int) -> int:
+    return int(environ.get(name, default))
+
+
+def _float(name: str, default: float) -> float:
+    return float(environ.get(name, default))
+
+
+def _flag(name: str, default: bool) -> bool:
+    return environ.get(name, str(int(default))).lower() in ("1", "true", "yes")
+
+
+# authenticated principals cached by session token
+PRINCIPAL_CACHE_SIZE = _int("PRINCIPAL_CACHE_SIZE", 10000)
+PRINCIPAL_CACHE_TTL = _float("PRINCIPAL_CACHE_TTL", 60)
+
+# public profiles served by /profiles and /avatar, and how many one
+# /profiles call may ask for
+PROFILE_CACHE_SIZE = _int("PROFILE_CACHE_SIZE", 10000)
+PROFILE_CACHE_TTL = _float("PROFILE_CACHE_TTL", 60)
+PROFILE_BATCH = _int("PROFILE_BATCH", 100)
+
+# "database" looks session tokens up in the session table, "signed" issues
+# HMAC-signed tokens that are verified without a query. Without a fixed
+# SECRET_KEY, signed tokens stop working when the process restarts, and
+# every worker signs with a key of its own.
+TOKEN_MODE = environ.get("TOKEN_MODE", "database")
+SECRET_KEY_SET = bool(environ.get("SECRET_KEY"))
+SECRET_KEY = environ.get("SECRET_KEY") or token_hex(32)
+# seconds a login lasts, for the cookie and for signed tokens
+TOKEN_LIFETIME = _float("TOKEN_LIFETIME", 14 * 24 * 60 * 60)
+# logins kept per user in the session table, the oldest go first
+MAX_SESSIONS_PER_USER = _int("MAX_SESSIONS_PER_USER", 10)
+
+# token bucket rate limits per client, as (requests per second, burst)
+RATE_LIMITING = _flag("RATE_LIMITING", True)
+RATE_LIMITS = {
+    "/login": (_float("LOGIN_RATE", 1), _int("LOGIN_BURST", 10)),
+    "/register": (_float("REGISTER_RATE", 0.1), _int("REGISTER_BURST", 5)),
+    "/attack": (_float("ATTACK_RATE", 10), _int("ATTACK_BURST", 30)),
+}
+# live buckets kept per route before the least recently used are dropped
+RATE_LIMIT_KEYS = _int("RATE_LIMIT_KEYS", 1_000_000)
+
+# e.g. sqlite:////var/lib/innovation/app.db for a durable file database
+DATABASE_URL = environ.get("DATABASE_URL", "sqlite:///:memory:")
+
+# server processes started by `python app.py`. More than one needs a shared
+# DATABASE_URL, and a "database" channel relaying cache invalidations and
+# live updates between them through its events table; "local" stays in the
+# process. The channel is exchanged every CHANNEL_INTERVAL seconds and its
+# events kept for CHANNEL_RETENTION.
+HOST = environ.get("HOST", "0.0.0.0")
+PORT = _int("PORT", 8080)
+WORKERS = _int("WORKERS", 1)
+CHANNEL = environ.get("CHANNEL", "database" if WORKERS > 1 else "local")
+CHANNEL_INTERVAL = _float("CHANNEL_INTERVAL", 0.05)
+CHANNEL_RETENTION = _float("CHANNEL_RETENTION", 60)
+
+# worker threads for blocking database and hashing work, 0 runs it inline
+DB_THREADS = _int("DB_THREADS", 4)
+CPU_THREADS = _int("CPU_THREADS", 4)
+# pooled connections, one per DB worker thread plus some headroom
+DB_POOL_SIZE = _int("DB_POOL_SIZE", DB_THREADS + 2)
+
+# password hashing processes, and how many hashes may be in flight before
+# /login and /register answer 503
+HASH_WORKERS = _int("HASH_WORKERS", cpu_count() or 1)
+HASH_QUEUE = _int("HASH_QUEUE", 4 * max(HASH_WORKERS, 1))
+
+# friends of friends counted per /friend_suggestions call, bounding its CPU
+# time for users with very large graphs
+FRIEND_SUGGESTION_BUDGET = _int("FRIEND_SUGGESTION_BUDGET", 20000)
+
+# exercise catalog source, and how often to check it for changes (seconds)
+EXERCISES_CSV = environ.get(
+    "EXERCISES_CSV", path.join(path.dirname(__file__), "exercises.csv")
+)
+CATALOG_CHECK_INTERVAL = _float("CATALOG_CHECK_INTERVAL", 5)
+
+# seconds per exercise in a /workout_plan, rest included, and the longest
+# workout one can ask for (minutes)
+WORKOUT_EXERCISE_SECONDS = _int("WORKOUT_EXERCISE_SECONDS", 60)
+WORKOUT_MAX_MINUTES = _int("WORKOUT_MAX_MINUTES", 120)
+
+# create the demo users (john/password, pog/champ) at startup
+SEED_DEMO = _flag("SEED_DEMO", False)
+
+# live session updates: distinct sessions buffered per slow subscriber, and
+# seconds between keepalives on an idle stream
+HUB_QUEUE_SIZE = _int("HUB_QUEUE_SIZE", 64)
+STREAM_HEARTBEAT = _float("STREAM_HEARTBEAT", 15)
+
+# directory of an append-only log of attacks, replacing the boss health
+# updates on gamesessions; boss health and per-user damage stats are kept
+# in memory and snapshotted every ATTACK_SNAPSHOT_INTERVAL seconds. Needs a
+# file DATABASE_URL and a single worker. Unset keeps attacks as row updates.
+# Without fsync, like the database, a logged attack survives a crash of the
+# server but not of the OS
+ATTACK_LOG = environ.get("ATTACK_LOG", "")
+ATTACK_SNAPSHOT_INTERVAL = _float("ATTACK_SNAPSHOT_INTERVAL", 60)
+ATTACK_LOG_FSYNC = _flag("ATTACK_LOG_FSYNC", False)
+
+# expired game session sweep: seconds between sweeps, sessions per delete
+REAPER_INTERVAL = _float("REAPER_INTERVAL", 300)
+REAPER_BATCH = _int("REAPER_BATCH", 500)
@@ -1,7 +1,8 @@
 from contextlib import contextmanager
+from contextvars import ContextVar
 from math import floor
 from time import time
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 from sqlalchemy import (
     Boolean,
@@ -11,20 +12,108 @@ from sqlalchemy import (
     Integer,
     String,
     Table,
+    and_,
+    bindparam,
+    or_,
     create_engine,
+    event,
+    select,
 )
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session, relationship
+from sqlalchemy.pool import QueuePool, StaticPool
+
+import config
+from attacklog import attacks
+from channel import channel
+from leaderboard import leaderboard
+
+# applied to every new connection to a file database
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    # WAL makes NORMAL durable against application crashes, only an OS crash
+    # can lose the last transactions
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def _create_engine(url: str) -> Engine:
+    url = make_url(url)
+    if url.get_backend_name() != "sqlite":
+        return create_engine(url, pool_size=config.DB_POOL_SIZE, pool_pre_ping=True)
+    if url.database in (None, "", ":memory:"):
+        # one connection shared by every thread, otherwise each thread would
+        # get its own empty in-memory database
+        return create_engine(
+            url,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+    engine = create_engine(
+        url,
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=0,
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(connection, _):
+        cursor = connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
 
-engine = create_engine("sqlite:///:memory:")
+
+engine = _create_engine(config.DATABASE_URL)
+SINGLE_CONNECTION = isinstance(engine.pool, StaticPool)
 
 Base = declarative_base()
 
+# exercises.csv tag letters and the Exercise columns they set
+EXERCISE_TAGS = {
+    "C": "core",
+    "L": "lower_body",
+    "U": "upper_body",
+    "B": "balance",
+    "V": "cardiovascular",
+}
+
 session_users = Table(
     "session_users",
     Base.metadata,
     Column("session_id", ForeignKey("gamesessions.id"), primary_key=True),
-    Column("user_id", ForeignKey("users.id"), primary_key=True),
+    Column("user_id", ForeignKey("users.id"), primary_key=True, index=True),
+)
+
+
+# changes relayed between worker processes, see channel.py
+events = Table(
+    "events",
+    Base.metadata,
+    Column("id", Integer, primary_key=True),
+    Column("origin", String),
+    Column("kind", String),
+    Column("payload", String),
+    Column("created", Float, index=True),
+    # ids are never reused once the oldest events are pruned
+    sqlite_autoincrement=True,
+)
+
+# signed tokens logged out before they expire, see tokens.py
+revocations = Table(
+    "revocations",
+    Base.metadata,
+    Column("session_id", String, primary_key=True),
+    Column("expires", Float, index=True),
 )
 
 
@@ -32,8 +121,105 @@ class NonUniqueException(Exception):
     pass
 
 
+class PartyError(Exception):
+    pass
+
+
+DAY = 24 * 60 * 60
+# party_health reaches 0 after this long, and the session is over
+SESSION_LIFETIME = 10 * DAY
+
+
+def party_health(start_time: float) -> int:
+    """
+    Parties lose 100 health for every full day a session has been running.
+    """
+    delta = time() - start_time
+    return 1000 - (100 * floor(delta / DAY))
+
+
+class UnitOfWork:
+    """
+    One session shared by everything a request does, committed once when
+    the request is done, or earlier by `commit_now()`. The session is only
+    opened on first use.
+    """
+
+    def __init__(self):
+        self.commits = 0
+        self._session: Optional[Session] = None
+        self._depth = 0
+
+    @property
+    def opened(self) -> bool:
+        return self._session is not None
+
+    @property
+    def session(self) -> Session:
+        if self._session is None:
+            self._session = Session(engine, info={"after_commit": []})
+        return self._session
+
+    @contextmanager
+    def use(self):
+        """
+        The session, for one `session_manager()` block. Until something has
+        been written, the connection is handed back after every outermost
+        block, so requests waiting on anything else don't hold it.
+        """
+        self._depth += 1
+        try:
+            yield self.session
+        finally:
+            self._depth -= 1
+            info = self._session.info
+            if not self._depth and not info.get("wrote"):
+                self._session.close()
+                if not info["after_commit"]:
+                    # nothing left for the end of the request
+                    self._session = None
+
+    def commit(self):
+        if self._session is None:
+            return
+        self._session.commit()
+        self._session.info.pop("wrote", None)
+        callbacks = self._session.info["after_commit"]
+        while callbacks:
+            callbacks.pop(0)()
+
+    def rollback(self):
+        if self._session is not None:
+            self._session.rollback()
+            self._session.info.pop("wrote", None)
+            self._session.info["after_commit"].clear()
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+unit_of_work: "ContextVar[Optional[UnitOfWork]]" = ContextVar(
+    "unit_of_work", default=None
+)
+
+
+@event.listens_for(engine, "commit")
+def count_commit(_):
+    current = unit_of_work.get()
+    if current is not None:
+        current.commits += 1
+
+
 @contextmanager
 def session_manager():
+    current = unit_of_work.get()
+    if current is not None:
+        # the request's unit of work commits or rolls back for us
+        with current.use() as session:
+            yield session
+        return
     session = Session(engine)
     try:
         yield session
@@ -44,6 +230,42 @@ def session_manager():
         session.close()
 
 
+def commit(session: Session):
+    """
+    Commit, or inside a unit of work only flush so ids are assigned and
+    constraint errors surface here, leaving the commit to the end of the
+    request.
+    """
+    if "after_commit" in session.info:
+        session.flush()
+        session.info["wrote"] = True
+    else:
+        session.commit()
+
+
+def commit_now(session: Session):
+    """
+    Commit a unit of work right away, along with its after_commit callbacks,
+    for requests whose writes are done. Waiting for the response to start
+    would hold SQLite's write lock across the trip back to the event loop
+    and on to the commit thread, with every other writer waiting on it.
+    """
+    current = unit_of_work.get()
+    if current is not None and "after_commit" in session.info:
+        current.commit()
+
+
+def after_commit(session: Session, callback: Callable[[], None]):
+    """
+    Run `callback` once `session`'s changes are committed, e.g. to drop
+    cache entries without a window where stale data could be re-cached.
+    """
+    if "after_commit" in session.info:
+        session.info["after_commit"].append(callback)
+    else:
+        callback()
+
+
 class _DBUser(Base):
     """
     User data as stored in the database.
@@ -52,7 +274,7 @@ class _DBUser(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True)
-    username = Column(String)
+    username = Column(String, index=True, unique=True)
     hash = Column(String)
     session_info = relationship("SessionInfo")
     friends = relationship("Friend")
@@ -68,13 +290,22 @@ class _DBUser(Base):
             id=user.id,
             username=user.username,
             hash=user.hash,
-            session_info=user.session_info,
-            friends=user.friends,
-            sessions=user.sessions,
             points=user.points,
             avatar=user.avatar,
+            **user.loaded(),
         )
 
+    @classmethod
+    def spend(cls, session: Session, id: int, price: int, avatar: str) -> bool:
+        """
+        Buy `avatar` for `price` points with one conditional UPDATE, so
+        concurrent purchases and payouts can't overwrite each other. False
+        if the user can't afford it (any more).
+        """
+        hit = session.execute(_spend, {"user_id": id, "price": price, "avatar": avatar})
+        commit(session)
+        return bool(hit.rowcount)
+
     @classmethod
     def query_unique(
         cls, session: Session, query: Dict[str, str]
@@ -91,9 +322,27 @@ class _DBUser(Base):
     def query(cls, session: Session, query: Dict[str, str]) -> "List[_DBUser]":
         return [x for x in session.query(_DBUser).filter_by(**query)]
 
+    @classmethod
+    def profiles(
+        cls, session: Session, ids: List[int], usernames: List[str]
+    ) -> List[Dict]:
+        """
+        Public profiles of the users with any of `ids` or `usernames`, in one
+        query that loads only those columns.
+        """
+        if not ids and not usernames:
+            return []
+        rows = session.query(cls.id, cls.username, cls.avatar, cls.points).filter(
+            or_(cls.id.in_(ids), cls.username.in_(usernames))
+        )
+        return [
+            {"id": id, "username": username, "avatar": avatar, "points": points or 0}
+            for id, username, avatar, points in rows
+        ]
+
     def write(self, session: Session):
         session.add(self)
-        session.commit()
+        commit(session)
 
 
 class GameSession(Base):
@@ -102,8 +351,8 @@ class GameSession(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String)
     bossHealth = Column(Integer, default=1000)
-    startTime = Column(Float, default=time)
-    tag = Column(String)
+    startTime = Column(Float, default=time, index=True)
+    tag = Column(String, index=True)
 
     users = relationship(
         "_DBUser", secondary=session_users, back_populates="sessions", lazy="joined"
@@ -123,56 +372,253 @@ class GameSession(Base):
     def query(cls, session: Session, query: Dict[str, str]) -> "List[GameSession]":
         return [x for x in session.query(GameSession).filter_by(**query)]
 
-    def as_dict(self):
+    @classmethod
+    def create_many(
+        cls,
+        session: Session,
+        creator: Tuple[int, str],
+        parties: List[Tuple[str, str, List[str]]],
+    ) -> List[Tuple[Dict, List[int]]]:
+        """
+        Create a session for each (name, tag, usernames) party, led by the
+        `creator` (id, username). All members are resolved with one query and
+        everything is written in a single transaction; an unknown or repeated
+        username raises PartyError before anything is written. Returns each
+        new session's state and its members' ids.
+        """
+        wanted = {username for _, _, usernames in parties for username in usernames}
+        ids = dict(
+            session.query(_DBUser.username, _DBUser.id).filter(
+                _DBUser.username.in_(wanted)
+            )
+        )
+        ids[creator[1]] = creator[0]
+        missing = sorted(wanted - ids.keys())
+        if missing:
+            raise PartyError(f"Unknown users: {', '.join(missing)}")
+        members = []
+        for _, _, usernames in parties:
+            if len(set(usernames)) != len(usernames):
+                raise PartyError("A party can't list the same user twice")
+            members.append(
+                [username for username in usernames if username != creator[1]]
+                + [creator[1]]
+            )
+
+        game_sessions = [cls(name=name, tag=tag) for name, tag, _ in parties]
+        session.add_all(game_sessions)
+        session.flush()
+        session.execute(
+            session_users.insert(),
+            [
+                {"session_id": game_session.id, "user_id": ids[username]}
+                for game_session, usernames in zip(game_sessions, members)
+                for username in usernames
+            ],
+        )
+        created = [
+            (
+                cls.format(
+                    game_session.id,
+                    game_session.name,
+                    game_session.bossHealth,
+                    game_session.startTime,
+                    usernames,
+                    game_session.tag,
+                ),
+                [ids[username] for username in usernames],
+            )
+            for game_session, usernames in zip(game_sessions, members)
+        ]
+        commit(session)
+        return created
+
+    @classmethod
+    def for_user(cls, session: Session, user_id: int) -> "List[GameSession]":
+        """
+        The user's sessions that haven't expired yet.
+        """
+        return [
+            x
+            for x in session.query(GameSession).filter(
+                GameSession.users.any(_DBUser.id == user_id),
+                GameSession.startTime > time() - SESSION_LIFETIME,
+            )
+        ]
+
+    @classmethod
+    def reap(cls, session: Session, limit: int) -> int:
+        """
+        Delete up to `limit` expired sessions and return how many went.
+        """
+        ids = [
+            id
+            for id, in session.query(GameSession.id)
+            .filter(GameSession.startTime <= time() - SESSION_LIFETIME)
+            .limit(limit)
+        ]
+        if not ids:
+            return 0
+        members = session.execute(
+            select([session_users.c.user_id]).where(session_users.c.session_id.in_(ids))
+        )
+        user_ids = {user_id for user_id, in members}
+        session.execute(
+            session_users.delete().where(session_users.c.session_id.in_(ids))
+        )
+        session.execute(cls.__table__.delete().where(cls.__table__.c.id.in_(ids)))
+        commit(session)
+        after_commit(session, lambda: channel.broadcast("bump", user_ids, "sessions"))
+        after_commit(session, lambda: attacks.forget(*ids))
+        return len(ids)
+
+    @classmethod
+    def attack(
+        cls, session: Session, id: int, damage: int
+    ) -> "Optional[Tuple[Dict, List[int]]]":
+        """
+        Deal damage with one conditional UPDATE, so concurrent attacks can't
+        overwrite each other's result. Once the boss is dead the UPDATE stops
+        matching, which makes the attack that killed it the only one to pay
+        out the party's points. Returns the session's state (empty once it
+        has been killed) and the party's user ids, or None if there's no live
+        session with this id.
+        """
+        connection = session.connection().execution_options(
+            compiled_cache=_compiled_attack
+        )
+        hit = connection.execute(
+            _damage, session_id=id, damage=damage, expired=time() - SESSION_LIFETIME
+        )
+        if not hit.rowcount:
+            return
+        row = connection.execute(_session_state, session_id=id).first()
+        members = connection.execute(_session_members, session_id=id).fetchall()
+        killed = row.bossHealth <= 0
+        if killed:
+            cls._pay(connection, id)
+        commit(session)
+        user_ids = [user_id for user_id, _ in members]
+        after_commit(session, lambda: channel.broadcast("bump", user_ids, "sessions"))
+        if killed:
+            after_commit(session, lambda: cls._paid(user_ids))
+            return {}, user_ids
+        state = cls.format(
+            row.id,
+            row.name,
+            row.bossHealth,
+            row.startTime,
+            [username for _, username in members],
+            row.tag,
+        )
+        return state, user_ids
+
+    @classmethod
+    def party(cls, session: Session, id: int) -> Optional[Tuple]:
+        """
+        A session's row and its members' (id, username), or None if there's
+        no such session.
+        """
+        connection = session.connection().execution_options(
+            compiled_cache=_compiled_attack
+        )
+        row = connection.execute(_session_state, session_id=id).first()
+        if row is None:
+            return
+        return row, connection.execute(_session_members, session_id=id).fetchall()
+
+    @classmethod
+    def boss_health(cls, session: Session, ids: Iterable[int]) -> Dict[int, int]:
+        """
+        Boss health in the rows of those of `ids` that still exist.
+        """
+        return dict(
+            session.query(GameSession.id, GameSession.bossHealth).filter(
+                GameSession.id.in_(list(ids))
+            )
+        )
+
+    @classmethod
+    def kill(cls, session: Session, id: int) -> Optional[List[int]]:
+        """
+        Pay out and delete a session whose boss the attack log saw die.
+        Returns the party's user ids, or None if the session is already
+        gone, so replaying a kill after a restart pays at most once.
+        """
+        found = cls.party(session, id)
+        if found is None:
+            return
+        user_ids = [user_id for user_id, _ in found[1]]
+        cls._pay(session.connection(), id)
+        commit(session)
+        after_commit(session, lambda: channel.broadcast("bump", user_ids, "sessions"))
+        after_commit(session, lambda: cls._paid(user_ids))
+        return user_ids
+
+    @staticmethod
+    def _pay(connection, id: int):
+        connection = connection.execution_options(compiled_cache=_compiled_attack)
+        connection.execute(_payout, session_id=id)
+        connection.execute(_clear_members, session_id=id)
+        connection.execute(_delete_session, session_id=id)
+
+    @staticmethod
+    def _paid(user_ids: List[int]):
+        leaderboard.add(user_ids, 100)
+        channel.send("points", user_ids)
+        channel.broadcast("bump", user_ids, "points")
+        # cached principals and profiles hold the party's points
+        channel.broadcast("invalidate_user", *user_ids)
+        channel.broadcast("invalidate_profile", *user_ids)
+
+    @staticmethod
+    def format(id, name, bossHealth, startTime, usernames, tag) -> Dict:
+        from catalog import catalog
+
         return {
-            "id": self.id,
-            "name": self.name,
-            "bossHealth": self.bossHealth,
-            "partyHealth": self.partyHealth,
-            "users": [user.username for user in self.users],
-            "tag": self.tag,
-            **self.exercises,
+            "id": id,
+            "name": name,
+            # the row's health, less any damage the attack log holds
+            "bossHealth": attacks.health(id, bossHealth),
+            "partyHealth": party_health(startTime),
+            "users": usernames,
+            "tag": tag,
+            **catalog().for_tag(tag),
         }
 
+    def as_dict(self):
+        return self.format(
+            self.id,
+            self.name,
+            self.bossHealth,
+            self.startTime,
+            [user.username for user in self.users],
+            self.tag,
+        )
+
     @property
     def exercises(self) -> Dict:
-        tag = {self.tag: True}
-        exercises = {}
-        with session_manager() as session:
-            exercises["beginner"] = [
-                x.name for x in Exercise.query(session, difficulty="beginner", **tag)
-            ]
-            exercises["intermediate"] = [
-                x.name
-                for x in Exercise.query(session, difficulty="intermediate", **tag)
-            ]
-            exercises["advanced"] = [
-                x.name for x in Exercise.query(session, difficulty="advanced", **tag)
-            ]
-            return exercises
+        from catalog import catalog
+
+        return catalog().for_tag(self.tag)
 
     @property
     def partyHealth(self):
-        day = 24 * 60 * 60
-        delta = time() - self.startTime
-        return 1000 - (100 * floor(delta / day))
+        return party_health(self.startTime)
 
     def check_status(self):
-        if self.partyHealth > 0:
-            return True
-        with session_manager() as session:
-            self.delete(session)
-        return False
+        # expired sessions are deleted by the reaper
+        return self.partyHealth > 0
 
     def write(self, session: Session):
         session.add(self)
-        session.commit()
+        commit(session)
 
     def delete(self, session: Session):
         self.users.clear()
         session.add(self)
         session.delete(self)
-        session.commit()
+        commit(session)
 
 
 class Exercise(Base):
@@ -192,11 +638,7 @@ class Exercise(Base):
         return cls(
             name=name,
             difficulty=difficulty,
-            core="C" in tags,
-            lower_body="L" in tags,
-            upper_body="U" in tags,
-            balance="B" in tags,
-            cardiovascular="V" in tags,
+            **{column: letter in tags for letter, column in EXERCISE_TAGS.items()},
         )
 
     @classmethod
@@ -205,10 +647,57 @@ class Exercise(Base):
 
     def write(self, session: Session):
         session.add(self)
-        session.commit()
+        commit(session)
 
     def __repr__(self):
         return f"<Exercise {self.name}/{self.difficulty}>"
 
 
-Base.metadata.create_all(engine)
+# statements for GameSession.attack, built once so their compiled form can be
+# cached instead of recompiled on every attack
+_compiled_attack: Dict = {}
+_sessions = GameSession.__table__
+_users = _DBUser.__table__
+_damage = (
+    _sessions.update()
+    .where(
+        and_(
+            _sessions.c.id == bindparam("session_id"),
+            _sessions.c.bossHealth > 0,
+            # sessions past SESSION_LIFETIME are over, even before the reaper
+            # deletes them
+            _sessions.c.startTime > bindparam("expired"),
+        )
+    )
+    .values(bossHealth=_sessions.c.bossHealth - bindparam("damage"))
+)
+_session_state = select([_sessions]).where(_sessions.c.id == bindparam("session_id"))
+_session_members = (
+    select([_users.c.id, _users.c.username])
+    .select_from(session_users.join(_users))
+    .where(session_users.c.session_id == bindparam("session_id"))
+)
+_payout = (
+    _users.update()
+    .where(
+        _users.c.id.in_(
+            select([session_users.c.user_id]).where(
+                session_users.c.session_id == bindparam("session_id")
+            )
+        )
+    )
+    .values(points=_users.c.points + 100)
+)
+_clear_members = session_users.delete().where(
+    session_users.c.session_id == bindparam("session_id")
+)
+_delete_session = _sessions.delete().where(_sessions.c.id == bindparam("session_id"))
+
+# for _DBUser.spend
+_spend = (
+    _users.update()
+    .where(
+        and_(_users.c.id == bindparam("user_id"), _users.c.points >= bindparam("price"))
+    )
+    .values(points=_users.c.points - bindparam("price"), avatar=bindparam("avatar"))
+)
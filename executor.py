@@ -0,0 +1,65 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Optional, TypeVar
+
+import config
+from database import SINGLE_CONNECTION
+
+T = TypeVar("T")
+
+_db_pool: Optional[ThreadPoolExecutor] = None
+_cpu_pool: Optional[ThreadPoolExecutor] = None
+
+
+def configure(db_threads: int = None, cpu_threads: int = None):
+    """
+    (Re)build the worker pools. A size of 0 runs the work inline on the
+    event loop, which is how every handler behaved before this module.
+    """
+    global _db_pool, _cpu_pool
+    db_threads = config.DB_THREADS if db_threads is None else db_threads
+    cpu_threads = config.CPU_THREADS if cpu_threads is None else cpu_threads
+    if SINGLE_CONNECTION:
+        # sessions on a shared connection would interleave their transactions
+        db_threads = min(db_threads, 1)
+    for pool in (_db_pool, _cpu_pool):
+        if pool:
+            pool.shutdown(wait=True)
+    _db_pool = (
+        ThreadPoolExecutor(db_threads, thread_name_prefix="db") if db_threads else None
+    )
+    _cpu_pool = (
+        ThreadPoolExecutor(cpu_threads, thread_name_prefix="cpu")
+        if cpu_threads
+        else None
+    )
+
+
+async def _run(
+    pool: Optional[ThreadPoolExecutor], fn: Callable[..., T], *args, **kwargs
+) -> T:
+    if pool is None:
+        return fn(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    # carry the caller's context, e.g. the request's unit of work
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(pool, partial(context.run, fn, *args, **kwargs))
+
+
+async def run_db(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run a blocking unit of database work off the event loop.
+    """
+    return await _run(_db_pool, fn, *args, **kwargs)
+
+
+async def run_cpu(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run CPU-heavy work (password hashing) off the event loop.
+    """
+    return await _run(_cpu_pool, fn, *args, **kwargs)
+
+
+configure()
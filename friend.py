@@ -1,18 +1,32 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from dataclasses import dataclass
-from sqlalchemy import Boolean, Column, ForeignKey, Integer
+from sqlalchemy import (
+    Boolean,
+    Column,
+    ForeignKey,
+    Index,
+    Integer,
+    and_,
+    case,
+    func,
+    or_,
+)
 from sqlalchemy.orm import Session, relationship
 
-from database import Base, NonUniqueException, engine, session_manager
+from database import Base, NonUniqueException, commit, _DBUser, session_manager
 
 
 class Friend(Base):
     __tablename__ = "friends"
+    # also serves lookups on user_id alone
+    __table_args__ = (
+        Index("ix_friends_user_id_friend_id", "user_id", "friend_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
-    friend_id = Column(Integer)
+    friend_id = Column(Integer, index=True)
     confirmed = Column(Boolean, default=False)
 
     user = relationship("_DBUser", back_populates="friends")
@@ -24,9 +38,75 @@ class Friend(Base):
 
     @classmethod
     def query(cls, id: int, session: Session) -> "Optional[Friend]":
-        friends = [x for x in session.query(Friend).filter_by(user_id=id)]
-        friends += [x for x in session.query(Friend).filter_by(friend_id=id)]
-        return friends
+        return [
+            x
+            for x in session.query(Friend).filter(
+                or_(Friend.user_id == id, Friend.friend_id == id)
+            )
+        ]
+
+    @classmethod
+    def confirmed_ids(cls, id: int, session: Session) -> "List[int]":
+        """
+        Ids of the users with a confirmed friendship with `id`.
+        """
+        other_id = case(
+            [(Friend.user_id == id, Friend.friend_id)], else_=Friend.user_id
+        )
+        return [
+            friend_id
+            for friend_id, in session.query(other_id).filter(
+                or_(Friend.user_id == id, Friend.friend_id == id),
+                Friend.confirmed.is_(True),
+            )
+        ]
+
+    @classmethod
+    def linked_ids(cls, id: int, session: Session) -> "List[int]":
+        """
+        Ids of the users with a friendship or a pending request with `id`, in
+        either direction.
+        """
+        other_id = case(
+            [(Friend.user_id == id, Friend.friend_id)], else_=Friend.user_id
+        )
+        return [
+            friend_id
+            for friend_id, in session.query(other_id).filter(
+                or_(Friend.user_id == id, Friend.friend_id == id)
+            )
+        ]
+
+    @classmethod
+    def page(
+        cls, id: int, session: Session, limit: int, after_id: Optional[int] = None
+    ) -> List[Dict]:
+        """
+        One page of a user's friends list, ordered by friend id, in a single
+        query that joins the other side of each edge to its user row. Outgoing
+        requests only show up once they've been confirmed.
+        """
+        other_id = case(
+            [(Friend.user_id == id, Friend.friend_id)], else_=Friend.user_id
+        )
+        query = (
+            session.query(
+                _DBUser.id, _DBUser.username, Friend.confirmed, _DBUser.avatar
+            )
+            .join(_DBUser, _DBUser.id == other_id)
+            .filter(
+                or_(
+                    and_(Friend.user_id == id, Friend.confirmed.is_(True)),
+                    Friend.friend_id == id,
+                )
+            )
+        )
+        if after_id is not None:
+            query = query.filter(_DBUser.id > after_id)
+        return [
+            {"id": id, "name": name, "confirmed": confirmed, "avatar": avatar}
+            for id, name, confirmed, avatar in query.order_by(_DBUser.id).limit(limit)
+        ]
 
     @classmethod
     def query_both(
@@ -46,11 +126,18 @@ class Friend(Base):
 
     def write(self, session: Session):
         session.add(self)
-        session.commit()
+        commit(session)
 
     def delete(self, session: Session):
         session.delete(self)
-        session.commit()
+        commit(session)
 
 
-Base.metadata.create_all(engine)
+# one row per pair of users, whichever of them asked, so two requests
+# crossing each other can't both go in
+Index(
+    "ix_friends_pair",
+    func.min(Friend.user_id, Friend.friend_id),
+    func.max(Friend.user_id, Friend.friend_id),
+    unique=True,
+)
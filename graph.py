@@ -0,0 +1,130 @@
+from collections import Counter
+from heapq import nlargest
+from itertools import islice
+from threading import Lock
+from typing import Dict, Iterable, List, Set, Tuple
+
+import config
+
+
+class FriendGraph:
+    """
+    Adjacency sets of the friends table, maintained by the write paths so
+    friendship checks and graph queries don't have to touch it. Confirmed
+    friendships are stored in both directions, pending requests only from
+    the requesting side, with a reverse index for the requested one.
+    """
+
+    def __init__(self, budget: int):
+        # friends of friends looked at per suggestion query
+        self.budget = budget
+        self._friends: Dict[int, Set[int]] = {}
+        self._sent: Dict[int, Set[int]] = {}
+        self._received: Dict[int, Set[int]] = {}
+        self._lock = Lock()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "users": len(self._friends),
+            "friendships": sum(len(x) for x in self._friends.values()) // 2,
+            "pending": sum(len(x) for x in self._sent.values()),
+        }
+
+    def load(self, edges: Iterable[Tuple[int, int, bool]]):
+        with self._lock:
+            self._friends.clear()
+            self._sent.clear()
+            self._received.clear()
+            for user_id, friend_id, confirmed in edges:
+                if confirmed:
+                    self._befriend(user_id, friend_id)
+                else:
+                    self._request(user_id, friend_id)
+
+    def request(self, user_id: int, friend_id: int):
+        with self._lock:
+            self._request(user_id, friend_id)
+
+    def confirm(self, user_id: int, friend_id: int):
+        with self._lock:
+            self._unlink(user_id, friend_id)
+            self._befriend(user_id, friend_id)
+
+    def remove(self, user_id: int, friend_id: int):
+        with self._lock:
+            self._unlink(user_id, friend_id)
+
+    def are_friends(self, a: int, b: int) -> bool:
+        return b in self._friends.get(a, ())
+
+    def linked(self, a: int, b: int) -> bool:
+        """
+        Whether there's a friendship or a request between `a` and `b`, in
+        either direction.
+        """
+        return (
+            b in self._friends.get(a, ())
+            or b in self._sent.get(a, ())
+            or a in self._sent.get(b, ())
+        )
+
+    def mutual(self, a: int, b: int) -> int:
+        with self._lock:
+            return len(self._friends.get(a, set()) & self._friends.get(b, set()))
+
+    def suggest(self, id: int, limit: int) -> List[Tuple[int, int]]:
+        """
+        Friends of friends that aren't linked to `id` yet, as (user id,
+        mutual friends), most mutual friends first. At most `budget` of them
+        are counted, split evenly between friends, so the friends of a
+        well-connected friend are sampled rather than crowding out the rest.
+        """
+        with self._lock:
+            friends = self._friends.get(id, set())
+            sent = self._sent.get(id, set())
+            received = self._received.get(id, set())
+            counts = Counter()
+            left = self.budget
+            share = max(self.budget // max(len(friends), 1), 1)
+            for friend in friends:
+                others = self._friends[friend]
+                taken = min(len(others), share, left)
+                counts.update(islice(others, taken))
+                left -= taken
+                if not left:
+                    break
+            candidates = [
+                (user_id, count)
+                for user_id, count in counts.items()
+                if user_id != id
+                and user_id not in friends
+                and user_id not in sent
+                and user_id not in received
+            ]
+        return nlargest(limit, candidates, key=lambda x: (x[1], -x[0]))
+
+    def _befriend(self, a: int, b: int):
+        self._friends.setdefault(a, set()).add(b)
+        self._friends.setdefault(b, set()).add(a)
+
+    def _request(self, user_id: int, friend_id: int):
+        self._sent.setdefault(user_id, set()).add(friend_id)
+        self._received.setdefault(friend_id, set()).add(user_id)
+
+    def _unlink(self, a: int, b: int):
+        for index, x, y in (
+            (self._friends, a, b),
+            (self._friends, b, a),
+            (self._sent, a, b),
+            (self._sent, b, a),
+            (self._received, a, b),
+            (self._received, b, a),
+        ):
+            edges = index.get(x)
+            if edges is not None:
+                edges.discard(y)
+                if not edges:
+                    del index[x]
+
+
+graph = FriendGraph(config.FRIEND_SUGGESTION_BUDGET)
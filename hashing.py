@@ -0,0 +1,111 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+import config
+from executor import run_cpu
+
+# new hashes use argon2, bcrypt hashes from older accounts are still accepted
+# and get upgraded the next time their owner logs in. argon2 is tuned to the
+# OWASP minimum (19 MiB, 2 passes) rather than passlib's far slower default.
+context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__memory_cost=19456,
+    argon2__rounds=2,
+    argon2__parallelism=1,
+    bcrypt__rounds=8,
+)
+
+
+class Saturated(Exception):
+    pass
+
+
+# workers are started once the DB and commit threads are running, and a
+# fork then could copy a lock some thread holds
+_START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+if _START_METHOD == "forkserver":
+    # imported once by the server, not by every worker
+    multiprocessing.set_forkserver_preload([__name__])
+
+
+def _hash(password: str) -> str:
+    return context.hash(password)
+
+
+def _verify(password: str, hash: str) -> Tuple[bool, Optional[str]]:
+    return context.verify_and_update(password, hash)
+
+
+class Hasher:
+    """
+    Password hashing on a process pool, so bursts of logins don't hold the
+    GIL. At most `queue` calls may be in flight; past that callers get
+    `Saturated` straight away instead of waiting behind everyone else.
+    """
+
+    def __init__(self, workers: int, queue: int):
+        self.workers = workers
+        self.queue = queue
+        self.pending = 0
+        self.rejected = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        """
+        Start the pool and one worker in the background, so the first login
+        doesn't wait for them.
+        """
+        if self.workers and self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context(_START_METHOD)
+            )
+            self._pool.submit(int)
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(_hash, password)
+
+    async def verify(self, password: str, hash: str) -> Tuple[bool, Optional[str]]:
+        """
+        Returns whether the password matches and, if the stored hash uses an
+        outdated scheme or cost, a replacement hash to store.
+        """
+        return await self._submit(_verify, password, hash)
+
+    async def _submit(self, fn, *args):
+        if self.pending >= self.queue:
+            self.rejected += 1
+            raise Saturated
+        self.pending += 1
+        try:
+            if not self.workers:
+                return await run_cpu(fn, *args)
+            self.start()
+            pool = self._pool
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(pool, partial(fn, *args))
+            except BrokenProcessPool:
+                # a worker died, e.g. killed for memory: start over next time
+                if self._pool is pool:
+                    self._pool = None
+                    pool.shutdown(wait=False)
+                raise
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown()
+            self._pool = None
+
+
+hasher = Hasher(config.HASH_WORKERS, config.HASH_QUEUE)
@@ -0,0 +1,106 @@
+import asyncio
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set
+
+import config
+
+
+class Subscriber:
+    """
+    One live connection's pending updates, keyed by game session. A newer
+    update for a session replaces the one still waiting, so a slow consumer
+    only ever sees the latest state; past `maxsize` distinct sessions the
+    oldest update is dropped.
+    """
+
+    def __init__(self, user_id: int, maxsize: int):
+        self.user_id = user_id
+        self.maxsize = maxsize
+        self.coalesced = 0
+        self.dropped = 0
+        self._pending: "OrderedDict[int, Dict]" = OrderedDict()
+        self._ready = asyncio.Event()
+
+    def offer(self, delta: Dict):
+        key = delta["id"]
+        if key in self._pending:
+            self.coalesced += 1
+        elif len(self._pending) >= self.maxsize:
+            self._pending.popitem(last=False)
+            self.dropped += 1
+        self._pending[key] = delta
+        self._ready.set()
+
+    async def next(self, timeout: float) -> List[Dict]:
+        """
+        Wait up to `timeout` seconds for updates and take all of them.
+        """
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self._ready.clear()
+        deltas = list(self._pending.values())
+        self._pending.clear()
+        return deltas
+
+
+class Hub:
+    """
+    In-process fan-out of game session updates to every connected member of
+    the party. Only touched from the event loop, so it needs no locking;
+    updates published from other threads, e.g. once a commit is done, are
+    handed over to it.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.published = 0
+        # counters of subscribers that have since disconnected
+        self._coalesced = 0
+        self._dropped = 0
+        self._subscribers: Dict[int, Set[Subscriber]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def subscribe(self, user_id: int) -> Subscriber:
+        self._loop = asyncio.get_running_loop()
+        subscriber = Subscriber(user_id, self.maxsize)
+        self._subscribers.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        subscribers = self._subscribers.get(subscriber.user_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        self._coalesced += subscriber.coalesced
+        self._dropped += subscriber.dropped
+        if not subscribers:
+            del self._subscribers[subscriber.user_id]
+
+    def publish(self, user_ids: Iterable[int], delta: Dict):
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is not loop:
+                loop.call_soon_threadsafe(self.publish, list(user_ids), delta)
+                return
+        self.published += 1
+        for user_id in user_ids:
+            for subscriber in self._subscribers.get(user_id, ()):
+                subscriber.offer(delta)
+
+    def stats(self) -> Dict[str, int]:
+        subscribers = [x for group in self._subscribers.values() for x in group]
+        return {
+            "subscribers": len(subscribers),
+            "published": self.published,
+            "coalesced": self._coalesced + sum(x.coalesced for x in subscribers),
+            "dropped": self._dropped + sum(x.dropped for x in subscribers),
+        }
+
+
+hub = Hub(config.HUB_QUEUE_SIZE)
@@ -0,0 +1,194 @@
+from math import log
+from random import random
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class _End:
+    """
+    Sorts after every key, terminates each level of the skip list.
+    """
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return self is other
+
+    def __gt__(self, other):
+        return self is not other
+
+    def __ge__(self, other):
+        return True
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, next: list, width: list):
+        self.key = key
+        self.next = next
+        self.width = width
+
+
+_END = _Node(_End(), [], [])
+
+
+class SkipList:
+    """
+    Indexable skip list: every link records how many elements it skips, so
+    insert, remove and the rank of a key are all O(log n).
+    """
+
+    def __init__(self, levels: int = 32):
+        self.levels = levels
+        self.size = 0
+        self._head = _Node(None, [_END] * levels, [1] * levels)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self) -> Iterator:
+        node = self._head.next[0]
+        while node is not _END:
+            yield node.key
+            node = node.next[0]
+
+    def insert(self, key):
+        chain = [None] * self.levels
+        steps = [0] * self.levels
+        node = self._head
+        for level in reversed(range(self.levels)):
+            while node.next[level].key <= key:
+                steps[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        height = min(self.levels, 1 - int(log(1 - random(), 2)))
+        new = _Node(key, [None] * height, [None] * height)
+        skipped = 0
+        for level in range(height):
+            previous = chain[level]
+            new.next[level] = previous.next[level]
+            previous.next[level] = new
+            new.width[level] = previous.width[level] - skipped
+            previous.width[level] = skipped + 1
+            skipped += steps[level]
+        for level in range(height, self.levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain = [None] * self.levels
+        node = self._head
+        for level in reversed(range(self.levels)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        target = chain[0].next[0]
+        if target is _END or target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            previous = chain[level]
+            previous.width[level] += target.width[level] - 1
+            previous.next[level] = target.next[level]
+        for level in range(len(target.next), self.levels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key) -> int:
+        """
+        Number of keys strictly smaller than `key`.
+        """
+        position = 0
+        node = self._head
+        for level in reversed(range(self.levels)):
+            while node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        return position
+
+
+class Leaderboard:
+    """
+    Players ordered by points (ties broken by id), maintained incrementally
+    by the write paths so neither top-K nor a player's rank has to sort the
+    users table.
+    """
+
+    def __init__(self):
+        self._players: Dict[int, Tuple[int, str]] = {}
+        self._order = SkipList()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._players)
+
+    def load(self, players: Iterable[Tuple[int, str, int]]):
+        with self._lock:
+            self._players.clear()
+            self._order = SkipList()
+            for id, username, points in players:
+                self._set(id, username, points or 0)
+
+    def set(self, id: int, username: str, points: int):
+        with self._lock:
+            self._set(id, username, points)
+
+    def update(self, players: Iterable[Tuple[int, str, int]]):
+        with self._lock:
+            for id, username, points in players:
+                self._set(id, username, points or 0)
+
+    def add(self, ids: Iterable[int], points: int):
+        """
+        Mirror a `points = points + ?` update on the users table.
+        """
+        with self._lock:
+            for id in ids:
+                if id in self._players:
+                    current, username = self._players[id]
+                    self._set(id, username, current + points)
+
+    def top(self, limit: int) -> List[Dict]:
+        with self._lock:
+            entries = []
+            for rank, (_, id) in enumerate(self._order, 1):
+                if rank > limit:
+                    break
+                entries.append(self._entry(rank, id))
+            return entries
+
+    def among(self, ids: Iterable[int], limit: int) -> List[Dict]:
+        """
+        Top entries restricted to `ids`, e.g. a player and their friends.
+        """
+        with self._lock:
+            keys = sorted(
+                (-self._players[id][0], id) for id in set(ids) if id in self._players
+            )
+            return [
+                self._entry(rank, id) for rank, (_, id) in enumerate(keys[:limit], 1)
+            ]
+
+    def rank(self, id: int) -> Optional[int]:
+        with self._lock:
+            if id not in self._players:
+                return
+            return self._order.rank(self._key(id)) + 1
+
+    def _set(self, id: int, username: str, points: int):
+        if id in self._players:
+            self._order.remove(self._key(id))
+        self._players[id] = (points, username)
+        self._order.insert(self._key(id))
+
+    def _key(self, id: int) -> Tuple[int, int]:
+        return -self._players[id][0], id
+
+    def _entry(self, rank: int, id: int) -> Dict:
+        points, username = self._players[id]
+        return {"rank": rank, "id": id, "name": username, "points": points}
+
+
+leaderboard = Leaderboard()
@@ -0,0 +1,188 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock, local
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from starlette.routing import Match
+from starlette.types import Scope
+
+from database import engine
+
+# upper bounds of the request latency histogram, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class RequestStats:
+    """
+    Database work done on behalf of one request. Its queries run one at a
+    time, so the counters need no lock.
+    """
+
+    __slots__ = ("queries", "db_time")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+class _Shard(RequestStats):
+    """
+    Database work outside of any request, e.g. the reaper, written only by
+    the thread that owns it.
+    """
+
+    __slots__ = ()
+
+
+request_stats: "ContextVar[Optional[RequestStats]]" = ContextVar(
+    "request_stats", default=None
+)
+
+
+class Metrics:
+    """
+    Request and database counters, rendered in the Prometheus text format.
+
+    Requests are recorded on the event loop and background queries in
+    per-thread shards, so nothing is locked on the hot path; everything is
+    added up when /metrics is scraped.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.in_flight = 0
+        self._requests: Dict[Tuple[str, str, int], int] = {}
+        # per (method, route): count per bucket plus +Inf, then the sum
+        self._latency: Dict[Tuple[str, str], List[float]] = {}
+        # per route: queries, seconds
+        self._db: Dict[str, List[float]] = {}
+        self._routes: Dict[Tuple[str, str], str] = {}
+        self._local = local()
+        self._shards: List[_Shard] = []
+        self._shards_lock = Lock()
+
+    def route(self, scope: Scope) -> str:
+        """
+        The path template of the route serving `scope`, so label values stay
+        bounded no matter which ids appear in the URL.
+        """
+        key = scope["method"], scope["path"]
+        route = self._routes.get(key)
+        if route is None:
+            route = "unmatched"
+            for candidate in scope["app"].router.routes:
+                match, _ = candidate.matches(scope)
+                if match != Match.NONE:
+                    route = candidate.path
+                    break
+            if len(self._routes) < 1024:
+                self._routes[key] = route
+        return route
+
+    def observe(
+        self,
+        method: str,
+        route: str,
+        status: int,
+        duration: float,
+        stats: RequestStats,
+    ):
+        key = method, route, status
+        self._requests[key] = self._requests.get(key, 0) + 1
+        latency = self._latency.get((method, route))
+        if latency is None:
+            latency = self._latency[method, route] = [0] * (len(self.buckets) + 2)
+        latency[bisect_left(self.buckets, duration)] += 1
+        latency[-1] += duration
+        db = self._db.get(route)
+        if db is None:
+            db = self._db[route] = [0, 0.0]
+        db[0] += stats.queries
+        db[1] += stats.db_time
+
+    def query(self, duration: float):
+        stats = request_stats.get()
+        if stats is None:
+            stats = getattr(self._local, "shard", None)
+            if stats is None:
+                stats = self._local.shard = _Shard()
+                with self._shards_lock:
+                    self._shards.append(stats)
+        stats.queries += 1
+        stats.db_time += duration
+
+    def render(self) -> str:
+        lines = [
+            "# HELP http_requests_total Requests served.",
+            "# TYPE http_requests_total counter",
+        ]
+        for (method, route, status), count in sorted(self._requests.items()):
+            labels = f'method="{method}",route="{route}",status="{status}"'
+            lines.append(f"http_requests_total{{{labels}}} {count}")
+
+        lines += [
+            "# HELP http_request_duration_seconds Time to serve a request.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (method, route), latency in sorted(self._latency.items()):
+            labels = f'method="{method}",route="{route}"'
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), latency):
+                cumulative += count
+                lines.append(
+                    f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} '
+                    f"{cumulative}"
+                )
+            lines.append(f"http_request_duration_seconds_sum{{{labels}}} {latency[-1]}")
+            lines.append(
+                f"http_request_duration_seconds_count{{{labels}}} {cumulative}"
+            )
+
+        lines += [
+            "# HELP http_requests_in_flight Requests being served.",
+            "# TYPE http_requests_in_flight gauge",
+            f"http_requests_in_flight {self.in_flight}",
+        ]
+
+        db = {route: list(values) for route, values in self._db.items()}
+        background = db.setdefault("background", [0, 0.0])
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            background[0] += shard.queries
+            background[1] += shard.db_time
+        lines += [
+            "# HELP db_queries_total SQL statements executed, by route.",
+            "# TYPE db_queries_total counter",
+        ]
+        for route, (queries, _) in sorted(db.items()):
+            lines.append(f'db_queries_total{{route="{route}"}} {queries}')
+        lines += [
+            "# HELP db_query_seconds_total Time spent executing SQL, by route.",
+            "# TYPE db_query_seconds_total counter",
+        ]
+        for route, (_, seconds) in sorted(db.items()):
+            lines.append(f'db_query_seconds_total{{route="{route}"}} {seconds}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def start_query(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("query_start", []).append(perf_counter())
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def end_query(connection, cursor, statement, parameters, context, executemany):
+    metrics.query(perf_counter() - connection.info["query_start"].pop())
+
+
+@event.listens_for(engine, "handle_error")
+def failed_query(context):
+    starts = context.connection.info.get("query_start") if context.connection else None
+    if starts:
+        metrics.query(perf_counter() - starts.pop())
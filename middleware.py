@@ -0,0 +1,208 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from time import perf_counter
+from typing import Dict, Optional
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import config
+
+from database import SINGLE_CONNECTION, UnitOfWork, unit_of_work
+from metrics import RequestStats, metrics, request_stats
+from ratelimit import limits
+
+# every commit goes through one thread of its own: a request holding the
+# SQLite write lock must never wait behind DB threads blocked on that lock
+_committer = ThreadPoolExecutor(1, thread_name_prefix="commit")
+
+_totals = {"requests": 0, "commits": 0}
+
+
+class UnitOfWorkMiddleware:
+    """
+    Gives each HTTP request one database session, shared by every model
+    helper it calls, and commits it once just before the response goes out
+    (or rolls it back for error responses), unless a handler already did
+    with `commit_now()`. The number of commits is sent back in an
+    X-DB-Commits header.
+
+    The in-memory database is a single shared connection, where transactions
+    of concurrent requests would mix, so there every helper keeps committing
+    on its own.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or SINGLE_CONNECTION:
+            await self.app(scope, receive, send)
+            return
+
+        work = UnitOfWork()
+        token = unit_of_work.set(work)
+        loop = asyncio.get_running_loop()
+        # commits are counted against the unit of work in the context
+        context = contextvars.copy_context()
+        finished = False
+
+        async def send_wrapper(message: Message):
+            nonlocal finished
+            if message["type"] == "http.response.start" and not finished:
+                finished = True
+                if not work.opened:
+                    # nothing to commit, e.g. a read, or a write already committed
+                    pass
+                elif message["status"] < 400:
+                    await loop.run_in_executor(_committer, context.run, work.commit)
+                else:
+                    await loop.run_in_executor(_committer, context.run, work.rollback)
+                message["headers"] = [
+                    *message.get("headers", ()),
+                    (b"x-db-commits", str(work.commits).encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            unit_of_work.reset(token)
+            if work.opened:
+                if not finished:
+                    await loop.run_in_executor(_committer, context.run, work.rollback)
+                await loop.run_in_executor(_committer, context.run, work.close)
+            _totals["requests"] += 1
+            _totals["commits"] += work.commits
+
+
+def commit_stats() -> Dict[str, int]:
+    return dict(_totals)
+
+
+class StartupClock:
+    """
+    How long startup took, and how long until the first response went out,
+    both measured from the start of the lifespan.
+    """
+
+    def __init__(self):
+        self._began: Optional[float] = None
+        self.startup_ms: Optional[float] = None
+        self.first_request_ms: Optional[float] = None
+
+    def begin(self):
+        self._began = perf_counter()
+        self.startup_ms = self.first_request_ms = None
+
+    def ready(self):
+        self.startup_ms = round((perf_counter() - self._began) * 1000, 3)
+
+    def responded(self):
+        if self.first_request_ms is None and self._began is not None:
+            self.first_request_ms = round((perf_counter() - self._began) * 1000, 3)
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        return {
+            "startup_ms": self.startup_ms,
+            "first_request_ms": self.first_request_ms,
+        }
+
+
+clock = StartupClock()
+
+
+class FirstRequestMiddleware:
+    """
+    Stops the startup clock when the first HTTP response starts.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or clock.first_request_ms is not None:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                clock.responded()
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+class MetricsMiddleware:
+    """
+    Records every HTTP request's route, status, latency and database work.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        status = 500
+        start = perf_counter()
+        metrics.in_flight += 1
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            metrics.in_flight -= 1
+            request_stats.reset(token)
+            metrics.observe(
+                scope["method"],
+                metrics.route(scope),
+                status,
+                perf_counter() - start,
+                stats,
+            )
+
+
+class RateLimitMiddleware:
+    """
+    Applies the per-route token buckets in ratelimit.py, answering 429 with
+    a Retry-After header once a client's bucket is empty. Must run inside
+    authentication, so signed-in clients are limited by user rather than by
+    address.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        limiter = limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limiter is None or not config.RATE_LIMITING:
+            await self.app(scope, receive, send)
+            return
+
+        user = scope.get("user")
+        if getattr(user, "is_authenticated", False):
+            key = user.id
+        else:
+            key = scope["client"][0] if scope.get("client") else None
+        wait = limiter.acquire(key)
+        if not wait:
+            await self.app(scope, receive, send)
+            return
+        response = JSONResponse(
+            {"success": False, "detail": "Too many requests, slow down"},
+            status_code=429,
+            headers={"Retry-After": str(ceil(wait))},
+        )
+        await response(scope, receive, send)
@@ -0,0 +1,134 @@
+from time import time
+from typing import Callable, List, Tuple, Union
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+import friend  # noqa: F401, registers its table
+from database import Base, engine
+from session import hash_token
+
+Step = Union[str, Callable[[Connection], None]]
+
+
+def _hash_tokens(connection: Connection):
+    """
+    Replace every stored token by its digest. Their age is unknown, so
+    existing sessions count as created now.
+    """
+    rows = connection.execute(
+        text("SELECT id, token FROM session WHERE token IS NOT NULL")
+    ).fetchall()
+    if rows:
+        connection.execute(
+            text(
+                "UPDATE session SET token_hash = :hash, token = NULL, "
+                "created = :created WHERE id = :id"
+            ),
+            [
+                {"id": id, "hash": hash_token(token), "created": time()}
+                for id, token in rows
+            ],
+        )
+
+
+# (version, description, steps), append only. A step is either a SQL
+# statement or a function taking the open connection.
+MIGRATIONS: List[Tuple[int, str, Tuple[Step, ...]]] = [
+    (
+        1,
+        "index hot lookup columns",
+        (
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_session_token ON session (token)",
+            "CREATE INDEX IF NOT EXISTS ix_session_user_id ON session (user_id)",
+            "CREATE INDEX IF NOT EXISTS ix_session_users_user_id "
+            "ON session_users (user_id)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_friends_user_id_friend_id "
+            "ON friends (user_id, friend_id)",
+            "CREATE INDEX IF NOT EXISTS ix_friends_friend_id ON friends (friend_id)",
+            "CREATE INDEX IF NOT EXISTS ix_gamesessions_tag ON gamesessions (tag)",
+        ),
+    ),
+    (
+        2,
+        "index session start times for the expiry sweep",
+        (
+            "CREATE INDEX IF NOT EXISTS ix_gamesessions_startTime "
+            'ON gamesessions ("startTime")',
+        ),
+    ),
+    (
+        3,
+        "store session tokens as indexed SHA-256 digests",
+        (
+            "ALTER TABLE session ADD COLUMN token_hash BLOB",
+            "ALTER TABLE session ADD COLUMN created FLOAT",
+            "DROP INDEX IF EXISTS ix_session_token",
+            _hash_tokens,
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_session_token_hash "
+            "ON session (token_hash)",
+            "CREATE INDEX IF NOT EXISTS ix_session_created ON session (created)",
+        ),
+    ),
+    (
+        4,
+        "allow one friendship row per pair of users",
+        (
+            # of a request and its reverse, keep the confirmed or older one
+            "DELETE FROM friends WHERE id IN ("
+            "SELECT f.id FROM friends f JOIN friends g "
+            "ON g.user_id = f.friend_id AND g.friend_id = f.user_id "
+            "AND g.id != f.id "
+            "WHERE COALESCE(g.confirmed, 0) > COALESCE(f.confirmed, 0) "
+            "OR (COALESCE(g.confirmed, 0) = COALESCE(f.confirmed, 0) AND g.id < f.id))",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_friends_pair "
+            "ON friends (min(user_id, friend_id), max(user_id, friend_id))",
+        ),
+    ),
+]
+
+LATEST = MIGRATIONS[-1][0]
+
+
+def migrate(engine: Engine = engine) -> int:
+    """
+    Bring the schema up to date and return its version. A fresh database is
+    created from the models, which already match the latest version.
+    """
+    with engine.begin() as connection:
+        if engine.dialect.name == "sqlite":
+            # take the write lock up front, so workers starting together
+            # migrate one after the other instead of failing to upgrade
+            # their read lock
+            connection.execute(text("BEGIN IMMEDIATE"))
+        fresh = not engine.dialect.has_table(connection, "users")
+        Base.metadata.create_all(connection)
+        connection.execute(
+            text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER)")
+        )
+        if fresh:
+            _stamp(connection, LATEST)
+            return LATEST
+        current = (
+            connection.execute(text("SELECT MAX(version) FROM schema_version")).scalar()
+            or 0
+        )
+        for version, _, steps in MIGRATIONS:
+            if version <= current:
+                continue
+            for step in steps:
+                if callable(step):
+                    step(connection)
+                else:
+                    connection.execute(text(step))
+            _stamp(connection, version)
+            current = version
+        return current
+
+
+def _stamp(connection: Connection, version: int):
+    connection.execute(
+        text("INSERT INTO schema_version (version) VALUES (:version)"),
+        version=version,
+    )
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Dict, Hashable, Optional
+
+import config
+
+
+class RateLimiter:
+    """
+    Token buckets allowing `rate` requests per second with bursts of up to
+    `burst`, one per key.
+
+    Each bucket is stored as a single float, the time at which it will be
+    full again (the generic cell rate algorithm), ordered by last use. A
+    bucket that is full again is the same as no bucket, so idle ones are
+    dropped as new keys arrive; past `maxsize` live buckets the least
+    recently used goes too.
+    """
+
+    def __init__(self, rate: float, burst: int, maxsize: int):
+        self.interval = 1 / rate
+        self.tolerance = burst * self.interval
+        self.maxsize = maxsize
+        self.allowed = 0
+        self.rejected = 0
+        self._full_at: "OrderedDict[Hashable, float]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._full_at)
+
+    def acquire(self, key: Hashable, now: Optional[float] = None) -> float:
+        """
+        Take a token for `key`. Returns 0 if there was one, otherwise the
+        seconds until there will be.
+        """
+        now = monotonic() if now is None else now
+        full_at = max(self._full_at.get(key, now), now) + self.interval
+        wait = full_at - now - self.tolerance
+        if wait > 0:
+            self.rejected += 1
+            return wait
+        self.allowed += 1
+        self._full_at[key] = full_at
+        self._full_at.move_to_end(key)
+        self._evict(now)
+        return 0
+
+    def _evict(self, now: float):
+        buckets = self._full_at
+        while buckets:
+            key, full_at = next(iter(buckets.items()))
+            if full_at > now and len(buckets) <= self.maxsize:
+                break
+            del buckets[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "buckets": len(self._full_at),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+        }
+
+
+# per route, keyed by user id once authenticated and by client address before
+limits = {
+    path: RateLimiter(rate, burst, config.RATE_LIMIT_KEYS)
+    for path, (rate, burst) in config.RATE_LIMITS.items()
+}
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+from time import perf_counter
+from typing import Dict, Optional
+
+import config
+from channel import channel
+from database import GameSession, session_manager
+from executor import run_db
+from session import SessionInfo
+from tokens import tokens
+
+logger = logging.getLogger(__name__)
+
+
+def sweep(batch: int) -> int:
+    with session_manager() as session:
+        return GameSession.reap(session, batch)
+
+
+def prune(batch: int) -> int:
+    with session_manager() as session:
+        user_ids = SessionInfo.prune(session, batch)
+    channel.broadcast("invalidate_user", *user_ids)
+    return len(user_ids)
+
+
+def forget(batch: int) -> int:
+    with session_manager() as session:
+        return len(tokens.prune(session, batch))
+
+
+class Reaper:
+    """
+    Background task deleting expired game sessions, logins and token
+    revocations in batches, so reads never have to clean up after them.
+    """
+
+    def __init__(self, interval: float, batch: int):
+        self.interval = interval
+        self.batch = batch
+        self.sweeps = 0
+        self.reaped = 0
+        self.pruned = 0
+        self.forgotten = 0
+        self.errors = 0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def sweep(self) -> int:
+        start = perf_counter()
+        reaped = 0
+        while True:
+            deleted = await run_db(sweep, self.batch)
+            reaped += deleted
+            if deleted < self.batch:
+                break
+        while True:
+            pruned = await run_db(prune, self.batch)
+            self.pruned += pruned
+            if pruned < self.batch:
+                break
+        while True:
+            forgotten = await run_db(forget, self.batch)
+            self.forgotten += forgotten
+            if forgotten < self.batch:
+                break
+        self.last_duration = perf_counter() - start
+        self.total_duration += self.last_duration
+        self.sweeps += 1
+        self.reaped += reaped
+        return reaped
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                # e.g. the database stayed locked past busy_timeout, the next
+                # sweep picks up where this one stopped
+                self.errors += 1
+                logger.exception("Sweep failed")
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> Dict:
+        return {
+            "sweeps": self.sweeps,
+            "reaped": self.reaped,
+            "pruned": self.pruned,
+            "revocations": self.forgotten,
+            "errors": self.errors,
+            "last_duration_ms": round(self.last_duration * 1000, 3),
+            "total_duration_ms": round(self.total_duration * 1000, 3),
+        }
+
+    def render(self) -> str:
+        """
+        The stats in the text exposition format, for /metrics.
+        """
+        return (
+            "\n".join(
+                [
+                    "# HELP reaper_sweeps_total Background sweeps completed.",
+                    "# TYPE reaper_sweeps_total counter",
+                    f"reaper_sweeps_total {self.sweeps}",
+                    "# HELP reaper_errors_total Background sweeps that failed.",
+                    "# TYPE reaper_errors_total counter",
+                    f"reaper_errors_total {self.errors}",
+                    "# HELP reaper_deleted_total Expired rows deleted, by kind.",
+                    "# TYPE reaper_deleted_total counter",
+                    f'reaper_deleted_total{{kind="sessions"}} {self.reaped}',
+                    f'reaper_deleted_total{{kind="logins"}} {self.pruned}',
+                    f'reaper_deleted_total{{kind="revocations"}} {self.forgotten}',
+                    "# HELP reaper_sweep_seconds_total Time spent sweeping.",
+                    "# TYPE reaper_sweep_seconds_total counter",
+                    f"reaper_sweep_seconds_total {self.total_duration}",
+                    "# HELP reaper_last_sweep_seconds Duration of the last sweep.",
+                    "# TYPE reaper_last_sweep_seconds gauge",
+                    f"reaper_last_sweep_seconds {self.last_duration}",
+                ]
+            )
+            + "\n"
+        )
+
+
+reaper = Reaper(config.REAPER_INTERVAL, config.REAPER_BATCH)
@@ -1,18 +1,30 @@
-from typing import Optional
+from hashlib import sha256
+from time import time
+from typing import List, Optional
 
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, Float, ForeignKey, Integer, LargeBinary
 from sqlalchemy.orm import Session, relationship
 
-from database import Base, NonUniqueException, engine, session_manager
+import config
+from database import Base, NonUniqueException, _DBUser, commit, session_manager
 from user import User
 
 
+def hash_token(token: str) -> bytes:
+    """
+    Only a digest of each token is stored, so a leaked table can't be used
+    to sign in.
+    """
+    return sha256(token.encode()).digest()
+
+
 class SessionInfo(Base):
     __tablename__ = "session"
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    token = Column(String)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    token_hash = Column(LargeBinary(32), index=True, unique=True)
+    created = Column(Float, default=time, index=True)
 
     user = relationship("_DBUser", back_populates="session_info")
 
@@ -20,20 +32,35 @@ class SessionInfo(Base):
         return (
             self.user_id == other.user_id
             and self.id == other.id
-            and self.token == other.token
+            and self.token_hash == other.token_hash
         )
 
     @classmethod
-    def find(cls, token: str) -> "Optional[_DBUser]":
+    def create(cls, user_id: int, token: str) -> "SessionInfo":
+        return cls(user_id=user_id, token_hash=hash_token(token), created=time())
+
+    @classmethod
+    def find(cls, token: str) -> "Optional[User]":
         with session_manager() as session:
-            session_info = cls.query(token, session)
-            if not session_info:
+            db_user = (
+                session.query(_DBUser)
+                .join(_DBUser.session_info)
+                .filter(
+                    SessionInfo.token_hash == hash_token(token),
+                    SessionInfo.created > time() - config.TOKEN_LIFETIME,
+                )
+                .first()
+            )
+            if not db_user:
                 return
-            return User.from_db(session_info.user)
+            return User.from_db(db_user)
 
     @classmethod
-    def query(cls, token: str, session: Session) -> "Optional[User]":
-        sessions = [x for x in session.query(SessionInfo).filter_by(token=token)]
+    def query(cls, token: str, session: Session) -> "Optional[SessionInfo]":
+        sessions = [
+            x
+            for x in session.query(SessionInfo).filter_by(token_hash=hash_token(token))
+        ]
         if len(sessions) == 0:
             return
         if len(sessions) > 1:
@@ -41,13 +68,50 @@ class SessionInfo(Base):
         session_info = sessions[0]
         return session_info
 
+    @classmethod
+    def cap(cls, session: Session, user_id: int, keep: int) -> int:
+        """
+        Delete all but the user's `keep` newest sessions and return how many
+        went.
+        """
+        newest = (
+            session.query(SessionInfo.id)
+            .filter_by(user_id=user_id)
+            .order_by(SessionInfo.created.desc(), SessionInfo.id.desc())
+            .limit(keep)
+        )
+        deleted = (
+            session.query(SessionInfo)
+            .filter(SessionInfo.user_id == user_id, ~SessionInfo.id.in_(newest))
+            .delete(synchronize_session=False)
+        )
+        commit(session)
+        return deleted
+
+    @classmethod
+    def prune(cls, session: Session, limit: int) -> List[int]:
+        """
+        Delete up to `limit` sessions older than TOKEN_LIFETIME and return
+        their users' ids.
+        """
+        expired = (
+            session.query(SessionInfo.id, SessionInfo.user_id)
+            .filter(SessionInfo.created <= time() - config.TOKEN_LIFETIME)
+            .limit(limit)
+            .all()
+        )
+        if not expired:
+            return []
+        session.query(SessionInfo).filter(
+            SessionInfo.id.in_([id for id, _ in expired])
+        ).delete(synchronize_session=False)
+        commit(session)
+        return [user_id for _, user_id in expired]
+
     def write(self, session: Session):
         session.add(self)
-        session.commit()
+        commit(session)
 
     def delete(self, session: Session):
         session.delete(self)
-        session.commit()
-
-
-Base.metadata.create_all(engine)
+        commit(session)
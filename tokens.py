@@ -0,0 +1,168 @@
+from calendar import timegm
+from hashlib import blake2b
+from secrets import token_urlsafe
+from threading import Lock
+from time import time
+from typing import Dict, List, NamedTuple, Optional
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import config
+
+
+class Claims(NamedTuple):
+    user_id: int
+    session_id: str
+    expires: float
+
+
+class Denylist:
+    """
+    Revoked session ids until their tokens expire anyway. A bloom filter
+    answers the common case, a token that was never revoked, without
+    touching the exact set; a hit is confirmed against the set.
+
+    Bloom filters can't forget, so there are two generations, swapped every
+    `lifetime` seconds: an id stays in one of them for at least `lifetime`
+    after it was revoked, which outlives its token.
+    """
+
+    def __init__(self, lifetime: float, bits: int = 1 << 20, hashes: int = 4):
+        self.lifetime = lifetime
+        self.bits = bits
+        self.hashes = hashes
+        self._current = bytearray(bits // 8)
+        self._previous = bytearray(bits // 8)
+        self._rotated = time()
+        self._revoked: Dict[str, float] = {}
+        self._lock = Lock()
+
+    def _positions(self, session_id: str):
+        digest = blake2b(session_id.encode(), digest_size=4 * self.hashes).digest()
+        for i in range(0, len(digest), 4):
+            yield int.from_bytes(digest[i : i + 4], "little") % self.bits
+
+    def revoke(self, session_id: str, expires: float):
+        with self._lock:
+            now = time()
+            if now - self._rotated >= self.lifetime:
+                self._previous = self._current
+                self._current = bytearray(self.bits // 8)
+                self._rotated = now
+                self._revoked = {k: v for k, v in self._revoked.items() if v > now}
+            for position in self._positions(session_id):
+                self._current[position >> 3] |= 1 << (position & 7)
+            self._revoked[session_id] = expires
+
+    def __contains__(self, session_id: str) -> bool:
+        positions = list(self._positions(session_id))
+        maybe = any(
+            all(bloom[p >> 3] & (1 << (p & 7)) for p in positions)
+            for bloom in (self._current, self._previous)
+        )
+        return maybe and session_id in self._revoked
+
+    def __len__(self):
+        return len(self._revoked)
+
+
+class Tokens:
+    """
+    Signed, time-limited session tokens carrying the user id and a session
+    id, checked with an HMAC instead of a database lookup.
+    """
+
+    def __init__(self, secret: str, lifetime: float):
+        self.lifetime = lifetime
+        self.denylist = Denylist(lifetime)
+        self.issued = 0
+        self.rejected = 0
+        self._serializer = URLSafeTimedSerializer(secret, salt="session")
+
+    def issue(self, user_id: int) -> str:
+        self.issued += 1
+        return self._serializer.dumps([user_id, token_urlsafe(12)])
+
+    def verify(self, token: str) -> Optional[Claims]:
+        """
+        The token's claims, or None if it's forged, expired or revoked.
+        """
+        try:
+            (user_id, session_id), issued = self._serializer.loads(
+                token, max_age=self.lifetime, return_timestamp=True
+            )
+        except (BadSignature, ValueError, TypeError):
+            self.rejected += 1
+            return
+        if session_id in self.denylist:
+            self.rejected += 1
+            return
+        # naive UTC in itsdangerous 1.x, aware in 2.x
+        expires = timegm(issued.utctimetuple()) + self.lifetime
+        return Claims(user_id, session_id, expires)
+
+    def revoke(self, token: str) -> Optional[Claims]:
+        claims = self.verify(token)
+        if claims:
+            self.denylist.revoke(claims.session_id, claims.expires)
+        return claims
+
+    def persist(self, session: Session, claims: Claims):
+        """
+        Record a revocation in the database, where workers started later
+        find it. Already recorded ones are left alone.
+        """
+        from database import commit, revocations
+
+        session.execute(
+            revocations.insert().prefix_with("OR IGNORE"),
+            {"session_id": claims.session_id, "expires": claims.expires},
+        )
+        commit(session)
+
+    def load(self, session: Session):
+        """
+        Revoke every session id recorded in the database whose token hasn't
+        expired yet, at startup.
+        """
+        from database import revocations
+
+        rows = session.execute(
+            revocations.select().where(revocations.c.expires > time())
+        )
+        for session_id, expires in rows:
+            self.denylist.revoke(session_id, expires)
+
+    def prune(self, session: Session, limit: int) -> List[str]:
+        """
+        Delete up to `limit` recorded revocations whose tokens have expired
+        and return their session ids.
+        """
+        from database import commit, revocations
+
+        expired = [
+            session_id
+            for session_id, in session.execute(
+                select([revocations.c.session_id])
+                .where(revocations.c.expires <= time())
+                .limit(limit)
+            )
+        ]
+        if expired:
+            session.execute(
+                revocations.delete().where(revocations.c.session_id.in_(expired))
+            )
+            commit(session)
+        return expired
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "issued": self.issued,
+            "rejected": self.rejected,
+            "revoked": len(self.denylist),
+        }
+
+
+tokens = Tokens(config.SECRET_KEY, config.TOKEN_LIFETIME)
@@ -1,32 +1,73 @@
 from base64 import b64encode
-from dataclasses import dataclass
 from os import urandom
-from typing import List, Optional
-
-from passlib.hash import bcrypt
-from sqlalchemy.orm.attributes import flag_dirty
-from starlette.authentication import BaseUser
-
-from database import _DBUser, session_manager
-
-
-@dataclass
-class User(BaseUser):
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy.orm import Query, Session
+
+import config
+from channel import channel
+from database import (
+    GameSession,
+    _DBUser,
+    after_commit,
+    commit_now,
+    session_manager,
+    session_users,
+)
+from graph import graph
+from hashing import context
+from leaderboard import leaderboard
+from tokens import tokens
+
+
+class User:
     """
     The main class used to interface with user data.
-    """
 
-    id: int
-    username: str
-    hash: bytes
-    session_info: "List[SessionInfo]"
-    friends: "List[Friend]"
-    sessions: "List[GameSession]"
-    points: int
-    avatar: str
+    Only the scalar columns are copied out of the database; `session_info`,
+    `friends` and `sessions` are queried the first time they are read, as
+    most requests never touch them.
+    """
 
-    _authenticated: bool = False
-    _auth_with: str = None
+    __slots__ = (
+        "id",
+        "username",
+        "hash",
+        "points",
+        "avatar",
+        "_authenticated",
+        "_auth_with",
+        "_session_info",
+        "_friends",
+        "_sessions",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        username: str,
+        hash: bytes,
+        session_info: "List[SessionInfo]" = None,
+        friends: "List[Friend]" = None,
+        sessions: "List[GameSession]" = None,
+        points: int = 0,
+        avatar: str = "default",
+        _authenticated: bool = False,
+        _auth_with: str = None,
+    ):
+        self.id = id
+        self.username = username
+        self.hash = hash
+        self.points = points
+        self.avatar = avatar
+        self._authenticated = _authenticated
+        self._auth_with = _auth_with
+        self._session_info = session_info
+        self._friends = friends
+        self._sessions = sessions
+
+    def __repr__(self):
+        return f"User(id={self.id!r}, username={self.username!r})"
 
     def __eq__(self, other):
         if not isinstance(other, User):
@@ -44,13 +85,69 @@ class User(BaseUser):
             id=db_user.id,
             username=db_user.username,
             hash=db_user.hash,
-            session_info=list(db_user.session_info),
-            friends=list(db_user.friends),
-            sessions=list(db_user.sessions),
             points=db_user.points,
             avatar=db_user.avatar,
         )
 
+    @property
+    def session_info(self) -> "List[SessionInfo]":
+        if self._session_info is None:
+            from session import SessionInfo
+
+            self._session_info = self._load(
+                lambda session: session.query(SessionInfo).filter_by(user_id=self.id)
+            )
+        return self._session_info
+
+    @session_info.setter
+    def session_info(self, value: "List[SessionInfo]"):
+        self._session_info = value
+
+    @property
+    def friends(self) -> "List[Friend]":
+        if self._friends is None:
+            from friend import Friend
+
+            self._friends = self._load(
+                lambda session: session.query(Friend).filter_by(user_id=self.id)
+            )
+        return self._friends
+
+    @friends.setter
+    def friends(self, value: "List[Friend]"):
+        self._friends = value
+
+    @property
+    def sessions(self) -> "List[GameSession]":
+        if self._sessions is None:
+            self._sessions = self._load(
+                lambda session: session.query(GameSession)
+                .join(session_users)
+                .filter(session_users.c.user_id == self.id)
+            )
+        return self._sessions
+
+    @sessions.setter
+    def sessions(self, value: "List[GameSession]"):
+        self._sessions = value
+
+    def loaded(self) -> Dict[str, list]:
+        """
+        The relationship collections read so far, by name.
+        """
+        collections = {
+            "session_info": self._session_info,
+            "friends": self._friends,
+            "sessions": self._sessions,
+        }
+        return {k: v for k, v in collections.items() if v is not None}
+
+    def _load(self, query: Callable[[Session], Query]) -> list:
+        if self.id is None:
+            return []
+        with session_manager() as session:
+            return query(session).all()
+
     @property
     def is_authenticated(self):
         return self._authenticated
@@ -61,7 +158,10 @@ class User(BaseUser):
 
     @classmethod
     def register(cls, username, password) -> "User":
-        hash = bcrypt.using(rounds=8).hash(password)
+        return cls.create(username, context.hash(password))
+
+    @classmethod
+    def create(cls, username, hash) -> "User":
         db_user = _DBUser(username=username, hash=hash)
         return cls.from_db(db_user)
 
@@ -77,12 +177,32 @@ class User(BaseUser):
         with session_manager() as session:
             user = _DBUser.from_user(self)
             user.write(session)
+            self.id = user.id
+
+            def written():
+                leaderboard.set(self.id, self.username, self.points or 0)
+                channel.send("points", [self.id])
+
+            after_commit(session, written)
 
     def authenticate(self, password) -> bool:
-        if bcrypt.verify(password, self.hash):
+        valid, new_hash = context.verify_and_update(password, self.hash)
+        if valid:
             self._authenticated = True
+        if new_hash:
+            self.rehash(new_hash)
         return self._authenticated
 
+    def rehash(self, hash: str):
+        """
+        Replace a stored hash whose scheme or cost has been deprecated.
+        """
+        self.hash = hash
+        with session_manager() as session:
+            user = _DBUser.query_unique(session, {"id": self.id})
+            user.hash = hash
+            user.write(session)
+
     def set_authenticated(self, authenticated=True, token=None) -> bool:
         if token:
             self._auth_with = token
@@ -95,19 +215,37 @@ class User(BaseUser):
     def new_token(self) -> str:
         from session import SessionInfo
 
+        if config.TOKEN_MODE == "signed":
+            return tokens.issue(self.id)
         token = b64encode(urandom(128)).decode("utf-8")
-        session_info = SessionInfo(user_id=self.id, token=token)
-        self.session_info.append(session_info)
+        session_info = SessionInfo.create(self.id, token)
         with session_manager() as session:
             session_info.write(session)
+            if SessionInfo.cap(session, self.id, config.MAX_SESSIONS_PER_USER):
+                # principals cached for the dropped tokens must go too
+                after_commit(
+                    session, lambda: channel.broadcast("invalidate_user", self.id)
+                )
+            commit_now(session)
+        # the cap may have dropped some, reload on next use
+        self._session_info = None
         return token
 
     def new_friend(self, friend_id: int):
         from friend import Friend
 
+        if graph.linked(self.id, friend_id):
+            return
         friend = Friend(user_id=self.id, friend_id=friend_id)
         with session_manager() as session:
-            if Friend.query_both(user_id=self.id, friend_id=friend_id, session=session):
-                return
-            self.friends.append(friend)
+            # raises IntegrityError if the other user just asked too
             friend.write(session)
+            if self._friends is not None:
+                self._friends.append(friend)
+
+            def befriended():
+                channel.broadcast("friend_request", self.id, friend_id)
+                channel.broadcast("invalidate_user", self.id, friend_id)
+                channel.broadcast("bump", [self.id, friend_id], "friends")
+
+            after_commit(session, befriended)
@@ -0,0 +1,45 @@
+from itertools import count
+from secrets import token_hex
+from time import time
+from typing import Dict, Hashable, Iterable, Tuple
+from urllib.parse import quote
+
+
+class Versions:
+    """
+    Version counters for data that clients poll, keyed by (owner, scope),
+    e.g. (user id, "sessions"). Write paths bump them once their changes
+    are committed, so an ETag can be built without touching the data.
+
+    Counters only live in this process; the epoch changes on every start
+    so tags from before a restart never match.
+    """
+
+    def __init__(self):
+        self.epoch = token_hex(4)
+        self._counter = count(1)
+        self._versions: Dict[Tuple[Hashable, str], int] = {}
+        self._expires: Dict[Tuple[Hashable, str], float] = {}
+
+    def bump(self, owners: Iterable[Hashable], scope: str):
+        for owner in owners:
+            self._versions[owner, scope] = next(self._counter)
+
+    def expire(self, owner: Hashable, scope: str, when: float):
+        """
+        Treat the data as changed at `when`, for data that changes with time
+        rather than through a write.
+        """
+        self._expires[owner, scope] = when
+
+    def etag(self, owner: Hashable, scope: str, *extra) -> str:
+        key = owner, scope
+        expires = self._expires.get(key)
+        if expires is not None and time() >= expires:
+            self._expires.pop(key, None)
+            self.bump([owner], scope)
+        parts = (self.epoch, scope, owner, self._versions.get(key, 0), *extra)
+        return 'W/"{}"'.format("-".join(quote(str(x)) for x in parts))
+
+
+versions = Versions()